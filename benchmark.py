@@ -0,0 +1,563 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import xml.etree.ElementTree as ElementTree
+
+from struct import pack, unpack_from, calcsize
+
+import util
+import collision
+import mapcompiler
+import pathfinding
+
+def time_frames(function, frames):
+    timestamp = time.time()
+
+    for _ in range(frames):
+        function()
+
+    return (time.time() - timestamp) / frames * 1000.0
+
+def bench_level_draw(map_filepath, frames=200, screen_size=(800, 600)):
+    import main
+
+    screen = setup_headless(screen_size)
+
+    level = main.GameLevel(map_filepath, screen_size)
+    level.setup()
+
+    results = {}
+
+    results['all'] = time_frames(lambda: level.draw_all(screen), frames)
+    results['culled'] = time_frames(lambda: level.draw_culled(screen), frames)
+
+    # the first frame bakes the visible chunks, time it separately from the cached frames
+    level.chunks.clear()
+    results['chunks_cold'] = time_frames(lambda: level.draw_chunks(screen), 1)
+    results['chunks'] = time_frames(lambda: level.draw_chunks(screen), frames)
+
+    return results
+
+def setup_headless(screen_size=(800, 600)):
+    # run pygame headless, this must be set before pygame is initialized
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+    import pygame
+
+    pygame.init()
+    return pygame.display.set_mode(screen_size)
+
+def get_layer_gids(map_filepath):
+    # the distinct gids of each layer, so synthetic maps use tiles that really exist
+    root = ElementTree.parse(map_filepath).getroot()
+
+    return [(element.get('name', ''), sorted(set(mapcompiler.parse_layer_data(element.find('data')))))
+        for element in root.findall('layer')]
+
+def write_synthetic_map(filepath, size, template_filepath='assets/Maps/test.tmx', seed=0):
+    template = ElementTree.parse(template_filepath).getroot()
+    template_dirpath = os.path.dirname(os.path.abspath(template_filepath))
+    rand = random.Random(seed)
+
+    root = ElementTree.Element('map', dict(template.attrib, width=str(size), height=str(size)))
+
+    # point at the template's tilesets, wherever the synthetic map is written to
+    for element in template.findall('tileset'):
+        tileset = ElementTree.SubElement(root, 'tileset', dict(element.attrib))
+
+        if tileset.get('source'):
+            tileset.set('source', os.path.normpath(os.path.join(template_dirpath, tileset.get('source'))))
+
+    for name, gids in get_layer_gids(template_filepath):
+        empty = 0 in gids
+        gids = [gid for gid in gids if gid] or [0]
+
+        # keep layers that are mostly empty in the template, like the cars, sparse
+        data = [rand.choice(gids) if not empty or rand.random() < 0.1 else 0 for _ in range(size * size)]
+
+        layer = ElementTree.SubElement(root, 'layer', {'name': name, 'width': str(size), 'height': str(size)})
+        ElementTree.SubElement(layer, 'data', {'encoding': 'csv'}).text = ','.join(map(str, data))
+
+    ElementTree.ElementTree(root).write(filepath, encoding='UTF-8', xml_declaration=True)
+    return filepath
+
+def get_camera_positions(level, screen_size):
+    tile_width, tile_height = level.tile_size
+    max_x = max(0, level.tmx_data.width * tile_width - screen_size[0])
+    max_y = max(0, level.tmx_data.height * tile_height - screen_size[1])
+
+    # the camera is the map position in the middle of the screen
+    half_width, half_height = screen_size[0] // 2, screen_size[1] // 2
+
+    return {
+        'origin': (half_width, half_height),
+        'center': (max_x // 2 + half_width, max_y // 2 + half_height),
+        'corner': (max_x + half_width, max_y + half_height),
+    }
+
+def bench_level_sizes(sizes=(32, 64, 128, 256), frames=50, screen_size=(800, 600)):
+    import main
+
+    screen = setup_headless(screen_size)
+    dirpath = tempfile.mkdtemp(prefix='syndicate-bench-')
+    results = {}
+
+    try:
+        for size in sizes:
+            map_filepath = write_synthetic_map(os.path.join(dirpath, 'synthetic-%d.tmx' % size), size)
+            result = results[str(size)] = {}
+
+            timestamp = time.time()
+            level = main.GameLevel(map_filepath, screen_size)
+            result['load_ms'] = (time.time() - timestamp) * 1000.0
+            result['setup_ms'] = time_frames(level.setup, 1)
+            result['draw'] = {}
+
+            for name, (x, y) in sorted(get_camera_positions(level, screen_size).items()):
+                level.camera.x, level.camera.y = x, y
+                level.chunks.clear()
+
+                result['draw'][name] = {
+                    'all_ms': time_frames(lambda: level.draw_all(screen), frames),
+                    'culled_ms': time_frames(lambda: level.draw_culled(screen), frames),
+                    'chunks_cold_ms': time_frames(lambda: level.draw_chunks(screen), 1),
+                    'chunks_ms': time_frames(lambda: level.draw_chunks(screen), frames),
+                }
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    return results
+
+def bench_map_load(sizes=(64, 128, 256, 512), screen_size=(800, 600)):
+    import main
+
+    screen = setup_headless(screen_size)
+    dirpath = tempfile.mkdtemp(prefix='syndicate-bench-')
+    results = {}
+
+    try:
+        for size in sizes:
+            tmx_filepath = write_synthetic_map(os.path.join(dirpath, 'synthetic-%d.tmx' % size), size)
+            compiled_filepath = mapcompiler.compile_map(tmx_filepath)
+            result = results[str(size)] = {}
+
+            for name, map_filepath in (('tmx', tmx_filepath), ('compiled', compiled_filepath)):
+                main.asset_cache.clear()
+
+                # until the first frame is on screen, which is what a player waits for
+                timestamp = time.time()
+                level = main.GameLevel(map_filepath, screen_size)
+                level.setup()
+                result['%s_load_ms' % name] = (time.time() - timestamp) * 1000.0
+                result['%s_first_frame_ms' % name] = time_frames(lambda: level.draw_chunks(screen), 1)
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    return results
+
+def bench_assets(rounds=50):
+    import main
+
+    setup_headless()
+
+    image_filepath = 'assets/Street.png'
+    results = {}
+
+    def load_cold():
+        main.asset_cache.clear()
+        main.GameUtil.load_image(image_filepath)
+
+    results['load_image_cold_ms'] = time_frames(load_cold, rounds)
+    results['load_image_cached_ms'] = time_frames(lambda: main.GameUtil.load_image(image_filepath), rounds)
+
+    def animator_cold():
+        main.asset_cache.clear()
+        main.PlayerAnimator.shared_state_dict = None
+        main.PlayerAnimator()
+
+    results['animator_cold_ms'] = time_frames(animator_cold, rounds)
+    results['animator_shared_ms'] = time_frames(main.PlayerAnimator, rounds)
+
+    return results
+
+def bench_render_suite(sizes=(32, 64, 128, 256), frames=50, screen_size=(800, 600)):
+    return {
+        'screen_size': list(screen_size),
+        'frames': frames,
+        'levels': bench_level_sizes(sizes, frames, screen_size),
+        'assets': bench_assets(),
+    }
+
+def bench_collision(sizes=(64, 256, 1024), queries=100000):
+    dirpath = tempfile.mkdtemp(prefix='syndicate-bench-')
+    rand = random.Random(0)
+    results = {}
+
+    try:
+        for size in sizes:
+            map_filepath = write_synthetic_map(os.path.join(dirpath, 'synthetic-%d.tmx' % size), size)
+            result = results[str(size)] = {}
+
+            timestamp = time.time()
+            grid = collision.WalkabilityGrid.from_tmx(map_filepath)
+            result['build_ms'] = (time.time() - timestamp) * 1000.0
+            result['walkable'] = sum(grid.cells) / float(len(grid.cells))
+
+            pixel_width = size * grid.tile_width
+            pixel_height = size * grid.tile_height
+
+            tiles = [(rand.randrange(size), rand.randrange(size)) for _ in range(queries)]
+            timestamp = time.time()
+
+            for tile_x, tile_y in tiles:
+                grid.is_walkable(tile_x, tile_y)
+
+            result['lookups_per_sec'] = queries / (time.time() - timestamp)
+
+            # the moves a player makes in a few frames, and the ones the server validates
+            moves = [(rand.randrange(pixel_width), rand.randrange(pixel_height),
+                rand.randint(-8, 8), rand.randint(-8, 8)) for _ in range(queries)]
+            timestamp = time.time()
+
+            for x, y, dx, dy in moves:
+                grid.move(x, y, dx, dy)
+
+            result['moves_per_sec'] = queries / (time.time() - timestamp)
+            timestamp = time.time()
+
+            for x, y, dx, dy in moves:
+                grid.is_move_valid(x, y, x + dx, y + dy)
+
+            result['validations_per_sec'] = queries / (time.time() - timestamp)
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    return results
+
+def bench_pathfinding(sizes=(64, 128, 256), queries=50):
+    dirpath = tempfile.mkdtemp(prefix='syndicate-bench-')
+    rand = random.Random(0)
+    results = {}
+
+    try:
+        for size in sizes:
+            map_filepath = write_synthetic_map(os.path.join(dirpath, 'synthetic-%d.tmx' % size), size)
+            grid = collision.WalkabilityGrid.from_tmx(map_filepath)
+            result = results[str(size)] = {}
+
+            walkable = [(x, y) for y in range(size) for x in range(size) if grid.is_walkable(x, y)]
+            pairs = [(rand.choice(walkable), rand.choice(walkable)) for _ in range(queries)]
+
+            cells = pathfinding.get_padded_cells(grid)
+            searches = (
+                ('astar', lambda start, goal: pathfinding.find_path_astar(grid, start, goal)),
+                ('jps', lambda start, goal: pathfinding.find_path_jps(grid, start, goal, cells)),
+            )
+
+            for name, search in searches:
+                timestamp = time.time()
+
+                for start, goal in pairs:
+                    search(start, goal)
+
+                result['%s_per_sec' % name] = queries / (time.time() - timestamp)
+
+            # the same clicks again, answered from the path cache
+            service = pathfinding.PathfindingService(grid, cache_size=queries)
+
+            for start, goal in pairs:
+                service.find(start, goal)
+
+            timestamp = time.time()
+
+            for start, goal in pairs:
+                service.find(start, goal)
+
+            result['cached_per_sec'] = queries / (time.time() - timestamp)
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    return results
+
+class LegacyPlayer(object):
+
+    def __init__(self, id, x, y):
+        self.id = id
+        self.x = x
+        self.y = y
+        self.dirty = False
+
+def bench_entities(entities=10000, moving=0.1, ticks=20):
+    import server
+
+    rand = random.Random(0)
+    players = dict((player_id, LegacyPlayer(player_id, 0, 0)) for player_id in range(1, entities + 1))
+
+    store = server.EntityStore()
+
+    for player_id in range(1, entities + 1):
+        store.add(player_id, True, 0, 0)
+
+    moves = [[(rand.randint(1, entities), rand.randint(0, 1000), rand.randint(0, 1000))
+        for _ in range(int(entities * moving))] for _ in range(ticks)]
+
+    def legacy_update(moves):
+        for player_id, x, y in moves:
+            player = players[player_id]
+            player.x = x
+            player.y = y
+            player.dirty = True
+
+    def legacy_tick():
+        # the old tick visited every player object to find the dirty ones
+        dirty_players = {}
+
+        for player in list(players.values()):
+            if not player.dirty:
+                continue
+
+            player.dirty = False
+            dirty_players[player.id] = (int(player.x), int(player.y))
+
+        return dirty_players
+
+    def columns_update(moves):
+        for player_id, x, y in moves:
+            store.set_position(player_id, x, y)
+
+    def columns_tick():
+        return dict((player_id, (x, y)) for player_id, x, y in store.collect_dirty())
+
+    results = {'numpy': server.numpy is not None}
+
+    # the updates arrive on the network threads, the tick is what holds up the snapshots
+    for name, update, tick in (('objects', legacy_update, legacy_tick), ('columns', columns_update, columns_tick)):
+        update_time = tick_time = 0.0
+
+        for tick_moves in moves:
+            timestamp = time.time()
+            update(tick_moves)
+            update_time += time.time() - timestamp
+
+            timestamp = time.time()
+            tick()
+            tick_time += time.time() - timestamp
+
+        results[name + '_updates'] = update_time / ticks * 1000.0
+        results[name + '_tick'] = tick_time / ticks * 1000.0
+
+    return results
+
+# the original bytes concatenating DataBuffer, kept to compare the struct codecs against
+class LegacyDataBuffer(object):
+
+    def __init__(self, data=bytes(), offset=0):
+        self._data = data
+        self._offset = offset
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def remaining(self):
+        return self._data[self._offset:]
+
+    def writeTo(self, fmt, *args):
+        self._data += pack('!%s' % fmt, *args)
+
+    def readFrom(self, fmt):
+        data = unpack_from('!%s' % fmt, self._data, self._offset)
+        self._offset += calcsize('!%s' % fmt)
+        return data
+
+    def readByte(self):
+        return self.readFrom('B')[0]
+
+    def writeByte(self, value):
+        self.writeTo('B', int(value))
+
+    def readSByte(self):
+        return self.readFrom('b')[0]
+
+    def writeSByte(self, value):
+        self.writeTo('b', int(value))
+
+    def readShort(self):
+        return self.readFrom('h')[0]
+
+    def writeShort(self, value):
+        self.writeTo('h', int(value))
+
+def legacy_roundtrip(count):
+    data_buffer = LegacyDataBuffer()
+
+    for index in range(count):
+        data_buffer.writeByte(util.PACKET_POSITION_UPDATE)
+        data_buffer.writeSByte(index & 0x7F)
+        data_buffer.writeShort(index)
+        data_buffer.writeShort(-index)
+
+    data_buffer = LegacyDataBuffer(data_buffer.data)
+
+    while len(data_buffer.remaining):
+        data_buffer.readByte()
+        data_buffer.readSByte()
+        data_buffer.readShort()
+        data_buffer.readShort()
+
+def codec_roundtrip(count):
+    data_buffer = util.DataBuffer()
+    codec = util.position_update_codec
+
+    for index in range(count):
+        codec.write(data_buffer, index & 0x7F, index, -index)
+
+    data_buffer = util.DataBuffer(data_buffer.data)
+
+    while len(data_buffer.remaining):
+        data_buffer.readByte()
+        codec.decode(data_buffer)
+
+def bench_data_buffer(packets=10000, rounds=10):
+    results = {}
+
+    for name, function in (('legacy', legacy_roundtrip), ('codec', codec_roundtrip)):
+        results[name] = time_frames(lambda: function(packets), rounds)
+
+    return results
+
+def bench_snapshots(players=64, seconds=10, frame_rate=60, tick_rate=20, moving=0.5):
+    # a random walk of every player, moving a pixel on some of the client frames
+    positions = dict((player_id, (random.randint(0, 1000), random.randint(0, 1000)))
+        for player_id in range(1, players + 1))
+
+    frames_per_tick = frame_rate // tick_rate
+    frame_size = util.frame_header.size
+
+    sent = {'rebroadcast': 0, 'snapshot': 0, 'delta': 0}
+    baseline = {}
+    dirty = set()
+
+    for frame in range(seconds * frame_rate):
+        for player_id, (x, y) in positions.items():
+            if random.random() > moving:
+                continue
+
+            positions[player_id] = (x + random.choice((-1, 0, 1)), y + random.choice((-1, 0, 1)))
+            dirty.add(player_id)
+
+            # the old server sent every update on to every other client straight away
+            sent['rebroadcast'] += frame_size + util.position_update_codec.packet.size
+
+        if frame % frames_per_tick:
+            continue
+
+        entries = [(player_id,) + positions[player_id] for player_id in sorted(dirty)]
+        sent['snapshot'] += sum(frame_size + len(data) for data in util.encode_snapshots(entries))
+
+        delta_entries = []
+
+        for player_id, x, y in entries:
+            if baseline.get(player_id) != (x, y):
+                delta_entries.append(util.encode_delta_entry(player_id, x, y, baseline.get(player_id)))
+                baseline[player_id] = (x, y)
+
+        sent['delta'] += sum(frame_size + len(data) for data in util.encode_delta_snapshots(delta_entries))
+        dirty.clear()
+
+    # every client receives the same amount in this simulation, except that
+    # a rebroadcasting server doesn't echo a client's own updates back to it
+    sent['rebroadcast'] = sent['rebroadcast'] * (players - 1) // players
+
+    return dict((name, size / float(seconds)) for name, size in sent.items())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Syndicate benchmarks')
+    parser.add_argument('benchmark', choices=['render', 'suite', 'load', 'collision', 'pathfinding', 'entities', 'buffer', 'snapshot'])
+    parser.add_argument('--map', default='assets/Maps/test.tmx')
+    parser.add_argument('--packets', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--entities', type=int, default=10000)
+    parser.add_argument('--sizes', type=int, nargs='+',
+        help='synthetic map sizes in tiles used by the suite, load, collision and pathfinding benchmarks')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--json', metavar='FILE',
+        help='write the suite results to FILE instead of printing them')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'render':
+        results = bench_level_draw(args.map)
+
+        print('draw (all tiles):     %.3f ms/frame' % results['all'])
+        print('draw (culled):        %.3f ms/frame' % results['culled'])
+        print('draw (chunks, cold):  %.3f ms/frame' % results['chunks_cold'])
+        print('draw (chunks, baked): %.3f ms/frame' % results['chunks'])
+
+    elif args.benchmark == 'suite':
+        results = bench_render_suite(args.sizes or [32, 64, 128, 256], args.frames)
+
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump(results, json_file, indent=4, sort_keys=True)
+        else:
+            print(json.dumps(results, indent=4, sort_keys=True))
+
+    elif args.benchmark == 'load':
+        results = bench_map_load(args.sizes or [64, 128, 256, 512])
+
+        for size in sorted(results, key=int):
+            result = results[size]
+
+            print('%sx%s tiles:' % (size, size))
+            print('    tmx:      %.1f ms load, %.1f ms first frame' % (result['tmx_load_ms'], result['tmx_first_frame_ms']))
+            print('    compiled: %.1f ms load, %.1f ms first frame' % (result['compiled_load_ms'], result['compiled_first_frame_ms']))
+
+    elif args.benchmark == 'collision':
+        results = bench_collision(args.sizes or [64, 256, 1024])
+
+        for size in sorted(results, key=int):
+            result = results[size]
+
+            print('%sx%s tiles: built in %.1f ms, %d%% walkable' % (size, size, result['build_ms'], result['walkable'] * 100))
+            print('    lookups:     %d/s' % result['lookups_per_sec'])
+            print('    moves:       %d/s' % result['moves_per_sec'])
+            print('    validations: %d/s' % result['validations_per_sec'])
+
+    elif args.benchmark == 'pathfinding':
+        results = bench_pathfinding(args.sizes or [64, 128, 256])
+
+        for size in sorted(results, key=int):
+            result = results[size]
+
+            print('%sx%s tiles, path queries per second:' % (size, size))
+            print('    a*:     %d' % result['astar_per_sec'])
+            print('    jps:    %d' % result['jps_per_sec'])
+            print('    cached: %d' % result['cached_per_sec'])
+
+    elif args.benchmark == 'entities':
+        results = bench_entities(args.entities)
+
+        print('server tick with %d players, 10%% of them moving%s:' % (args.entities, '' if results['numpy'] else ' (no numpy)'))
+        print('player objects: %.3f ms applying updates, %.3f ms tick scan' % (results['objects_updates'], results['objects_tick']))
+        print('column store:   %.3f ms applying updates, %.3f ms tick scan' % (results['columns_updates'], results['columns_tick']))
+
+    elif args.benchmark == 'buffer':
+        results = bench_data_buffer(args.packets)
+
+        print('%d position updates written and read back:' % args.packets)
+        print('legacy DataBuffer: %.3f ms' % results['legacy'])
+        print('struct codecs:     %.3f ms (%.1fx)' % (results['codec'], results['legacy'] / results['codec']))
+
+    elif args.benchmark == 'snapshot':
+        results = bench_snapshots(args.players)
+
+        print('bytes/sec received per client with %d players:' % args.players)
+        print('re-broadcast updates: %d' % results['rebroadcast'])
+        print('full snapshots:       %d' % results['snapshot'])
+        print('delta snapshots:      %d' % results['delta'])
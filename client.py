@@ -1,8 +1,13 @@
+import time
+import errno
 import socket
+import collections
 import threading
 import util
 import main
 
+from metrics import metrics
+
 host, port = '127.0.0.1', 10000
 
 global players
@@ -11,38 +16,151 @@ players = None
 global owned_player
 owned_player = None
 
+# the last position the server sent in a delta snapshot for every player
+global snapshot_baseline
+snapshot_baseline = {}
+
 global sock
 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock.connect((host, port))
+
+# position updates sent per second, newer updates replace the pending one in between
+send_rate = 20
+
+# outgoing packets are queued and written to the socket from the writer
+# thread, so the render loop never blocks on a socket write
+global send_condition
+send_condition = threading.Condition()
+
+global send_queue
+send_queue = []
+
+global pending_position
+pending_position = None
+
+global last_sent_position
+last_sent_position = None
+
+# positions of our own player that were sent but not acknowledged by the server yet
+global sent_positions
+sent_positions = collections.deque(maxlen=64)
+
+# position updates and snapshots can go over udp instead, spawns and despawns stay on tcp
+udp_enabled = False
+
+# emulates loss and latency of the udp traffic in both directions, for testing on localhost
+udp_emulator = None
+
+global udp_sock
+udp_sock = None
+
+# the server sends the token for our udp datagrams once we are connected
+global udp_token
+udp_token = None
+
+global udp_connected
+udp_connected = False
+
+global udp_send_sequence
+udp_send_sequence = 0
+
+global udp_recv_sequence
+udp_recv_sequence = 0
+
+def connect():
+    global udp_sock
+
+    sock.connect((host, port))
+
+    if udp_enabled:
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.connect((host, port))
+
+def udploop():
+    while True:
+        try:
+            data = udp_sock.recv(65536)
+        except socket.error as e:
+            # the server's udp port isn't open (yet), keep listening
+            if e.args[0] == errno.ECONNREFUSED:
+                continue
+
+            break
+
+        metrics.increment('net.datagrams_in')
+        metrics.increment('net.bytes_in', len(data))
+
+        if udp_emulator:
+            udp_emulator.schedule(handle_datagram, data)
+        else:
+            handle_datagram(data)
+
+def handle_datagram(data):
+    global udp_connected, udp_recv_sequence
+
+    try:
+        token, sequence, data_buffer = util.unpack_datagram(data)
+        packet_id = data_buffer.readByte()
+    except:
+        return
+
+    # drop datagrams that aren't ours, and ones older than the newest we handled
+    if token != udp_token or sequence <= udp_recv_sequence:
+        return
+
+    udp_recv_sequence = sequence
+    udp_connected = True
+
+    # only unreliable traffic is accepted over udp
+    if packet_id not in (util.PACKET_SNAPSHOT, util.PACKET_DELTA_SNAPSHOT):
+        return
+
+    handle_packet(packet_id, data_buffer)
+
+def send_datagram(data):
+    global udp_send_sequence
+
+    udp_send_sequence += 1
+    datagram = util.pack_datagram(udp_token, udp_send_sequence, data)
+
+    metrics.increment('net.datagrams_out')
+    metrics.increment('net.bytes_out', len(datagram))
+
+    try:
+        if udp_emulator:
+            udp_emulator.schedule(udp_sock.send, datagram)
+        else:
+            udp_sock.send(datagram)
+    except socket.error:
+        return
 
 def mainloop():
+    decoder = util.PacketDecoder()
+
     while True:
-        data = sock.recv(1024)
+        data = sock.recv(4096)
 
         if not data:
             break
 
-        data_buffer = util.DataBuffer(data)
+        metrics.increment('net.bytes_in', len(data))
 
-        while len(data_buffer.remaining):
+        for data_buffer in decoder.feed(data):
+            metrics.increment('net.packets_in')
             handle_packet(data_buffer.readByte(), data_buffer)
 
 def handle_packet(packet_id, data_buffer):
+    global owned_player, udp_token
+
     if packet_id == util.PACKET_SPAWN:
         try:
-            player_id = data_buffer.readSByte()
-            owned = data_buffer.readByte()
-            x = data_buffer.readShort()
-            y = data_buffer.readShort()
-
-            # clear the buffer
-            data_buffer.clear()
+            player_id, owned, x, y = util.spawn_codec.decode(data_buffer)
         except:
             return
 
         if owned:
             # create a new player instance as an owned object
             player = main.Player(player_id, True)
+            owned_player = player
 
             #player_group.add(player)
             #player_group.center(player.rect.center)
@@ -52,17 +170,26 @@ def handle_packet(packet_id, data_buffer):
         player.x = x
         player.y = y
 
+        # the server deltas the player's next positions against the one it spawned it with
+        snapshot_baseline[player_id] = (x, y)
+
+        if owned:
+            # the server echoes our spawn position back in its first snapshot
+            with send_condition:
+                sent_positions.append((x, y))
+        else:
+            player.add_snapshot(time.time(), x, y)
+
         players[player_id] = player
 
     elif packet_id == util.PACKET_DESPAWN:
         try:
-            player_id = data_buffer.readSByte()
-
-            # clear the buffer
-            data_buffer.clear()
+            player_id, = util.despawn_codec.decode(data_buffer)
         except:
             return
 
+        snapshot_baseline.pop(player_id, None)
+
         if player_id not in players:
             return
 
@@ -70,12 +197,7 @@ def handle_packet(packet_id, data_buffer):
 
     elif packet_id == util.PACKET_POSITION_UPDATE:
         try:
-            player_id = data_buffer.readSByte()
-            x = data_buffer.readShort()
-            y = data_buffer.readShort()
-
-            # clear the buffer
-            data_buffer.clear()
+            player_id, x, y = util.position_update_codec.decode(data_buffer)
         except:
             return
 
@@ -83,25 +205,166 @@ def handle_packet(packet_id, data_buffer):
             return
 
         player = players[player_id]
-        player.x = x
-        player.y = y
+
+        # a correction of our own player is applied as is, other players are
+        # interpolated between their updates like they are between snapshots
+        if player.owner:
+            player.x = x
+            player.y = y
+        else:
+            player.add_snapshot(time.time(), x, y)
+
+    elif packet_id in (util.PACKET_SNAPSHOT, util.PACKET_DELTA_SNAPSHOT):
+        try:
+            if packet_id == util.PACKET_DELTA_SNAPSHOT:
+                entries = util.decode_delta_snapshot(data_buffer, snapshot_baseline)
+            else:
+                entries = util.decode_snapshot(data_buffer)
+        except:
+            return
+
+        timestamp = time.time()
+
+        for player_id, x, y in entries:
+            if player_id not in players:
+                continue
+
+            player = players[player_id]
+
+            # our own player is predicted locally, the server's position is only reconciled with it
+            if player.owner:
+                player.server_position = (x, y)
+            else:
+                player.add_snapshot(timestamp, x, y)
+
+    elif packet_id == util.PACKET_TICK_RATE:
+        try:
+            tick_rate, = util.tick_rate_codec.decode(data_buffer)
+        except:
+            return
+
+        # without a tick loop position updates arrive as they are sent, keep the defaults
+        if tick_rate:
+            main.Player.set_tick_rate(tick_rate)
+
+    elif packet_id == util.PACKET_UDP_TOKEN:
+        try:
+            token, = util.udp_token_codec.decode(data_buffer)
+        except:
+            return
+
+        if not udp_sock:
+            return
+
+        # the writer introduces us over udp with this token
+        with send_condition:
+            udp_token = token
+            send_condition.notify()
+
+def writerloop():
+    global last_sent_position
+
+    interval = 1.0 / send_rate
+    next_position_send = time.time()
+
+    while True:
+        with send_condition:
+            # queued packets wake us up straight away, position updates wait for their turn
+            if not send_queue:
+                send_condition.wait(max(0, next_position_send - time.time()))
+
+            metrics.set_gauge('net.send_queue', len(send_queue))
+
+            frames = send_queue[:]
+            del send_queue[:]
+
+            position = None
+            hello = False
+
+            use_udp = udp_token is not None
+
+            if time.time() >= next_position_send:
+                next_position_send = time.time() + interval
+
+                # skip positions the server already has
+                if pending_position != last_sent_position:
+                    position = last_sent_position = pending_position
+                    sent_positions.append(position[1:])
+
+                # udp datagrams can get lost, keep resending until the server acknowledged our position
+                elif use_udp and sent_positions and pending_position:
+                    position = pending_position
+
+                # until the server answers over udp, an empty datagram tells it where to send to
+                hello = use_udp and not udp_connected and not position
+
+        if position and use_udp:
+            send_datagram(util.position_update_codec.encode(*position))
+        elif position:
+            frames.append(util.pack_frame(util.position_update_codec.encode(*position)))
+
+        if hello:
+            send_datagram(b'')
+
+        if not frames:
+            continue
+
+        data = b''.join(frames)
+
+        metrics.increment('net.packets_out', len(frames))
+        metrics.increment('net.bytes_out', len(data))
+
+        # everything that piled up goes out in a single write
+        try:
+            sock.sendall(data)
+        except socket.error:
+            break
+
+def queue_send(data):
+    with send_condition:
+        send_queue.append(util.pack_frame(data))
+        send_condition.notify()
 
 def handle_send_request_spawn():
-    data_buffer = util.DataBuffer()
-    data_buffer.writeByte(util.PACKET_REQUEST_SPAWN)
+    queue_send(util.request_spawn_codec.encode())
+
+def acknowledge_position(x, y):
+    global last_sent_position
+
+    with send_condition:
+        if (x, y) in sent_positions:
+            # everything sent before the acknowledged position was superseded by it
+            while sent_positions.popleft() != (x, y):
+                pass
+
+            return True, None
 
-    sock.send(data_buffer.data)
+        # the server changed our position, return the first position it didn't acknowledge
+        position = sent_positions[0] if sent_positions else None
+        sent_positions.clear()
+
+        # make sure our corrected position is sent, even if it matches the last one we sent
+        last_sent_position = None
+
+        return False, position
 
 def handle_send_position_update(player):
-    data_buffer = util.DataBuffer()
-    data_buffer.writeByte(util.PACKET_POSITION_UPDATE)
-    data_buffer.writeSByte(player.id)
-    data_buffer.writeShort(player.x)
-    data_buffer.writeShort(player.y)
+    global pending_position
 
-    sock.send(data_buffer.data)
+    # only the latest position matters, it replaces any update that wasn't sent yet
+    with send_condition:
+        pending_position = (player.id, int(player.x), int(player.y))
 
 def run_mainloop():
     t = threading.Thread(target=mainloop)
     t.daemon = True
     t.start()
+
+    t = threading.Thread(target=writerloop)
+    t.daemon = True
+    t.start()
+
+    if udp_sock:
+        t = threading.Thread(target=udploop)
+        t.daemon = True
+        t.start()
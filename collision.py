@@ -0,0 +1,241 @@
+import os
+import math
+import xml.etree.ElementTree as ElementTree
+
+import mapcompiler
+
+# tiles from these tilesets block movement wherever they are placed
+BLOCKING_TILESETS = ('cars',)
+
+# the layer every walkable tile needs a tile on
+GROUND_LAYER = 'ground'
+
+# the box a player collides with, relative to its position: x offset, y offset, width, height.
+# the sprites are 64x64 with the agent's feet at the bottom, only the feet collide, and
+# they fit in a single tile so players can follow tile paths through one tile gaps
+PLAYER_BOX = (24, 48, 16, 14)
+
+def get_tile_properties(element):
+    properties = {}
+
+    for tile in element.findall('tile'):
+        values = dict((prop.get('name'), prop.get('value', '')) for prop in tile.findall('properties/property'))
+        properties[int(tile.get('id'))] = values
+
+    return properties
+
+def is_blocking(properties):
+    if properties.get('walkable', 'true').lower() == 'false':
+        return True
+
+    return properties.get('blocked', properties.get('collides', 'false')).lower() == 'true'
+
+def get_blocked_gids(root, map_dirpath):
+    # a blocked gid range for each blocking tileset, and the single gids blocked by their tile properties
+    blocked_ranges = []
+    blocked_gids = set()
+
+    for element in root.findall('tileset'):
+        firstgid = int(element.get('firstgid'))
+
+        # external tilesets only keep their first gid in the map file
+        if element.get('source'):
+            element = ElementTree.parse(os.path.join(map_dirpath, element.get('source'))).getroot()
+
+        if element.get('name') in BLOCKING_TILESETS:
+            blocked_ranges.append((firstgid, firstgid + int(element.get('tilecount', 0))))
+
+        for tile_id, properties in get_tile_properties(element).items():
+            if is_blocking(properties):
+                blocked_gids.add(firstgid + tile_id)
+
+    return blocked_ranges, blocked_gids
+
+class WalkabilityGrid(object):
+
+    def __init__(self, width, height, tile_width, tile_height, cells=None):
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+
+        # one byte per tile, 1 when the tile can be walked on
+        self.cells = cells if cells is not None else bytearray(b'\x01') * (width * height)
+
+    @classmethod
+    def from_tmx(cls, filepath):
+        if not os.path.exists(filepath):
+            raise IOError('Failed to load map file %s!' % filepath)
+
+        root = ElementTree.parse(filepath).getroot()
+        width, height = int(root.get('width')), int(root.get('height'))
+
+        grid = cls(width, height, int(root.get('tilewidth')), int(root.get('tileheight')))
+        blocked_ranges, blocked_gids = get_blocked_gids(root, os.path.dirname(os.path.abspath(filepath)))
+
+        cells = grid.cells
+        blocked_cache = {0: False}
+
+        for element in root.findall('layer'):
+            gids = mapcompiler.parse_layer_data(element.find('data'))
+            ground = element.get('name') == GROUND_LAYER
+
+            for index, gid in enumerate(gids):
+                # nothing to stand on without a ground tile
+                if ground and not gid:
+                    cells[index] = 0
+                    continue
+
+                # maps only use a few distinct tiles, so each gid is only classified once
+                blocked = blocked_cache.get(gid)
+
+                if blocked is None:
+                    tile_gid = gid & mapcompiler.GID_MASK
+                    blocked = blocked_cache[gid] = tile_gid in blocked_gids or any(
+                        start <= tile_gid < end for start, end in blocked_ranges)
+
+                if blocked:
+                    cells[index] = 0
+
+        return grid
+
+    @classmethod
+    def from_compiled(cls, compiled_map):
+        return cls(compiled_map.width, compiled_map.height, compiled_map.tilewidth, compiled_map.tileheight,
+            compiled_map.get_walkability_cells())
+
+    def is_walkable(self, tile_x, tile_y):
+        # everything outside of the map is blocked
+        if tile_x < 0 or tile_y < 0 or tile_x >= self.width or tile_y >= self.height:
+            return False
+
+        return self.cells[tile_y * self.width + tile_x] == 1
+
+    def is_walkable_at(self, x, y):
+        return self.is_walkable(int(x // float(self.tile_width)), int(y // float(self.tile_height)))
+
+    def get_box_tile(self, x, y, box=PLAYER_BOX):
+        # the tile under the center of the box
+        offset_x, offset_y, width, height = box
+        return int((x + offset_x + width / 2.0) // self.tile_width), int((y + offset_y + height / 2.0) // self.tile_height)
+
+    def get_box_position(self, tile_x, tile_y, box=PLAYER_BOX):
+        # the position that centers the box on a tile
+        offset_x, offset_y, width, height = box
+        x = tile_x * self.tile_width + (self.tile_width - width) // 2 - offset_x
+        y = tile_y * self.tile_height + (self.tile_height - height) // 2 - offset_y
+
+        return x, y
+
+    def get_tile_span(self, start, size, tile_size):
+        # the first and last tile a span of pixels overlaps
+        return int(math.floor(start / float(tile_size))), int(math.ceil((start + size) / float(tile_size))) - 1
+
+    def is_area_walkable(self, x, y, box=PLAYER_BOX):
+        offset_x, offset_y, width, height = box
+        start_x, end_x = self.get_tile_span(x + offset_x, width, self.tile_width)
+        start_y, end_y = self.get_tile_span(y + offset_y, height, self.tile_height)
+
+        for tile_y in range(start_y, end_y + 1):
+            for tile_x in range(start_x, end_x + 1):
+                if not self.is_walkable(tile_x, tile_y):
+                    return False
+
+        return True
+
+    def is_column_walkable(self, tile_x, start_y, end_y):
+        for tile_y in range(start_y, end_y + 1):
+            if not self.is_walkable(tile_x, tile_y):
+                return False
+
+        return True
+
+    def is_row_walkable(self, tile_y, start_x, end_x):
+        for tile_x in range(start_x, end_x + 1):
+            if not self.is_walkable(tile_x, tile_y):
+                return False
+
+        return True
+
+    def sweep_x(self, x, y, dx, width, height):
+        # only the tiles ahead of the box are tested, so a box that ended up
+        # inside a blocked tile can still walk out of it
+        start_y, end_y = self.get_tile_span(y, height, self.tile_height)
+
+        if dx > 0:
+            first = int(math.ceil((x + width) / float(self.tile_width)))
+            last = int(math.ceil((x + width + dx) / float(self.tile_width))) - 1
+
+            for tile_x in range(first, last + 1):
+                if not self.is_column_walkable(tile_x, start_y, end_y):
+                    return tile_x * self.tile_width - width
+
+        elif dx < 0:
+            first = int(math.floor(x / float(self.tile_width))) - 1
+            last = int(math.floor((x + dx) / float(self.tile_width)))
+
+            for tile_x in range(first, last - 1, -1):
+                if not self.is_column_walkable(tile_x, start_y, end_y):
+                    return (tile_x + 1) * self.tile_width
+
+        return x + dx
+
+    def sweep_y(self, x, y, dy, width, height):
+        start_x, end_x = self.get_tile_span(x, width, self.tile_width)
+
+        if dy > 0:
+            first = int(math.ceil((y + height) / float(self.tile_height)))
+            last = int(math.ceil((y + height + dy) / float(self.tile_height))) - 1
+
+            for tile_y in range(first, last + 1):
+                if not self.is_row_walkable(tile_y, start_x, end_x):
+                    return tile_y * self.tile_height - height
+
+        elif dy < 0:
+            first = int(math.floor(y / float(self.tile_height))) - 1
+            last = int(math.floor((y + dy) / float(self.tile_height)))
+
+            for tile_y in range(first, last - 1, -1):
+                if not self.is_row_walkable(tile_y, start_x, end_x):
+                    return (tile_y + 1) * self.tile_height
+
+        return y + dy
+
+    def move(self, x, y, dx, dy, box=PLAYER_BOX, y_first=False):
+        # sweep the box along one axis and then the other, stopping flush against the first blocked tile
+        offset_x, offset_y, width, height = box
+        box_x, box_y = x + offset_x, y + offset_y
+
+        if y_first:
+            box_y = self.sweep_y(box_x, box_y, dy, width, height)
+            box_x = self.sweep_x(box_x, box_y, dx, width, height)
+        else:
+            box_x = self.sweep_x(box_x, box_y, dx, width, height)
+            box_y = self.sweep_y(box_x, box_y, dy, width, height)
+
+        return box_x - offset_x, box_y - offset_y
+
+    def is_move_valid(self, x, y, new_x, new_y, box=PLAYER_BOX):
+        # a move that combines several steps may have gone around a corner
+        # either way, so it's valid if sweeping along either axis first gets there
+        dx, dy = new_x - x, new_y - y
+
+        if self.move(x, y, dx, dy, box) == (new_x, new_y):
+            return True
+
+        return bool(dx and dy) and self.move(x, y, dx, dy, box, True) == (new_x, new_y)
+
+def load_walkability(map_filepath):
+    if not os.path.exists(map_filepath):
+        return None
+
+    # compiled maps carry the grid they were compiled with, no xml is parsed for them
+    if map_filepath.endswith(mapcompiler.MAP_EXTENSION):
+        compiled_map = mapcompiler.CompiledMap(map_filepath, None)
+
+        try:
+            return WalkabilityGrid.from_compiled(compiled_map)
+        finally:
+            compiled_map.close()
+
+    return WalkabilityGrid.from_tmx(map_filepath)
@@ -0,0 +1,375 @@
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+import resource
+import subprocess
+import multiprocessing
+
+import util
+import collision
+
+class BotStats(object):
+
+    def __init__(self):
+        self.connected = 0
+        self.spawned = 0
+        self.disconnected = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.malformed = 0
+        self.latencies = []
+
+    def merge(self, other):
+        for name, value in other.items():
+            if name == 'latencies':
+                self.latencies.extend(value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class Bot(object):
+
+    def __init__(self, index, args, stats, send_times, walkability=None):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.walkability = walkability
+
+        # (player id, x, y) -> when it was sent, shared by every bot in this process
+        # so the other bots can tell how long the update took to reach them
+        self.send_times = send_times
+
+        self.player_id = None
+        self.base_x = 0
+        self.x = 0
+        self.y = 0
+        self.direction = 1
+        self.row_direction = 1
+
+        self.baseline = {}
+
+    def can_move(self, x, y):
+        return self.walkability is None or self.walkability.is_move_valid(self.x, self.y, x, y)
+
+    def step(self):
+        # walk back and forth a pixel per step, moving a row at the end of every pass,
+        # so the steps land on different positions and updates can be told apart
+        x, y = self.x + self.direction, self.y
+
+        if abs(x - self.base_x) >= 200 or not self.can_move(x, y):
+            self.direction = -self.direction
+            x, y = self.x, self.y + self.row_direction
+
+            if not self.can_move(x, y):
+                self.row_direction = -self.row_direction
+                x, y = self.x, self.y
+
+        self.x, self.y = x, y
+        return x, y
+
+    async def run(self, deadline):
+        try:
+            reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        except OSError:
+            self.stats.disconnected += 1
+            return
+
+        self.stats.connected += 1
+        self.send(writer, util.request_spawn_codec.encode())
+
+        sender = asyncio.ensure_future(self.send_forever(writer))
+
+        try:
+            await asyncio.wait_for(self.receive_forever(reader), max(0, deadline - time.time()))
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    def send(self, writer, data):
+        frame = util.pack_frame(data)
+        writer.write(frame)
+
+        self.stats.packets_sent += 1
+        self.stats.bytes_sent += len(frame)
+
+    async def send_forever(self, writer):
+        interval = 1.0 / self.args.rate
+
+        # spread the bots over the send interval instead of having them all send at once
+        await asyncio.sleep(random.random() * interval)
+
+        while True:
+            if self.player_id is not None:
+                x, y = self.step()
+
+                self.send_times[(self.player_id, x, y)] = time.time()
+                self.send(writer, util.position_update_codec.encode(self.player_id, x, y))
+
+                # don't let the writer's buffer grow forever if the server can't keep up
+                await writer.drain()
+
+            await asyncio.sleep(interval)
+
+    async def receive_forever(self, reader):
+        decoder = util.PacketDecoder()
+
+        while True:
+            data = await reader.read(65536)
+
+            if not data:
+                self.stats.disconnected += 1
+                return
+
+            self.stats.bytes_received += len(data)
+
+            for data_buffer in decoder.feed(data):
+                self.stats.packets_received += 1
+
+                # drop malformed packets the same way the game client does
+                try:
+                    self.handle_packet(data_buffer.readByte(), data_buffer)
+                except (ValueError, util.StructError):
+                    self.stats.malformed += 1
+
+    def handle_packet(self, packet_id, data_buffer):
+        if packet_id == util.PACKET_SPAWN:
+            player_id, owned, x, y = util.spawn_codec.decode(data_buffer)
+            self.baseline[player_id] = (x, y)
+
+            if owned:
+                self.player_id = player_id
+                self.base_x = self.x = x
+                self.y = y
+                self.stats.spawned += 1
+
+        elif packet_id == util.PACKET_DESPAWN:
+            player_id, = util.despawn_codec.decode(data_buffer)
+            self.baseline.pop(player_id, None)
+
+        elif packet_id == util.PACKET_POSITION_UPDATE:
+            self.handle_position(*util.position_update_codec.decode(data_buffer))
+
+        elif packet_id == util.PACKET_SNAPSHOT:
+            for entry in util.decode_snapshot(data_buffer):
+                self.handle_position(*entry)
+
+        elif packet_id == util.PACKET_DELTA_SNAPSHOT:
+            for entry in util.decode_delta_snapshot(data_buffer, self.baseline):
+                self.handle_position(*entry)
+
+    def handle_position(self, player_id, x, y):
+        # the server echoes our own position back, that isn't a broadcast
+        if player_id == self.player_id:
+            return
+
+        timestamp = self.send_times.get((player_id, x, y))
+
+        if timestamp is not None:
+            self.stats.latencies.append(time.time() - timestamp)
+
+async def run_bots(first_index, count, args):
+    stats = BotStats()
+    send_times = {}
+
+    # walk where the server lets players walk, or every other update would be corrected
+    walkability = collision.load_walkability(args.map) if args.map else None
+
+    deadline = time.time() + args.ramp + args.duration
+    tasks = []
+
+    for index in range(first_index, first_index + count):
+        tasks.append(asyncio.ensure_future(Bot(index, args, stats, send_times, walkability).run(deadline)))
+
+        # ramp the connections up instead of flooding the server's accept queue
+        await asyncio.sleep(args.ramp / float(count))
+
+    await asyncio.gather(*tasks)
+    return stats
+
+def run_process(first_index, count, args, results):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    stats = loop.run_until_complete(run_bots(first_index, count, args))
+    results.put(stats.to_dict())
+
+def get_process_stat(pid):
+    # the fields after the process name in linux's /proc stat file
+    with open('/proc/%d/stat' % pid) as stat_file:
+        return stat_file.read().rsplit(')', 1)[1].split()
+
+def get_child_pids(pid):
+    # /proc doesn't always list a process' children, find them by their parent pid instead
+    child_pids = []
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            fields = get_process_stat(int(name))
+        except IOError:
+            continue
+
+        if int(fields[1]) == pid:
+            child_pids.append(int(name))
+
+    return child_pids
+
+def get_process_usage(pid):
+    # cpu seconds and resident memory of a process and its children, like the shards of a sharded server
+    fields = get_process_stat(pid)
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    rss = int(fields[21]) * resource.getpagesize()
+
+    for child_pid in get_child_pids(pid):
+        try:
+            child_cpu, child_rss = get_process_usage(child_pid)
+        except IOError:
+            continue
+
+        cpu += child_cpu
+        rss += child_rss
+
+    return cpu, rss
+
+def get_children_cpu(pid):
+    # cpu seconds of every child of a process by its pid, the shards of a sharded server
+    children_cpu = {}
+
+    for child_pid in get_child_pids(pid):
+        try:
+            children_cpu[child_pid] = get_process_usage(child_pid)[0]
+        except IOError:
+            continue
+
+    return children_cpu
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(args):
+    server = None
+    server_pid = args.server_pid
+
+    if args.launch_server is not None:
+        server_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        server = subprocess.Popen([sys.executable, server_filepath, '--port', str(args.port),
+            '--map', args.map] + args.launch_server.split())
+        server_pid = server.pid
+
+        # give the server a moment to bind its port
+        time.sleep(1.0)
+
+    server_usage = get_process_usage(server_pid) if server_pid else None
+    children_cpu = get_children_cpu(server_pid) if server_pid else None
+
+    processes = []
+    results = multiprocessing.Queue()
+    per_process = (args.clients + args.processes - 1) // args.processes
+
+    timestamp = time.time()
+
+    for first_index in range(0, args.clients, per_process):
+        count = min(per_process, args.clients - first_index)
+
+        process = multiprocessing.Process(target=run_process, args=(first_index, count, args, results))
+        process.start()
+        processes.append(process)
+
+    stats = BotStats()
+
+    for process in processes:
+        stats.merge(results.get())
+
+    for process in processes:
+        process.join()
+
+    elapsed = time.time() - timestamp
+
+    report = {
+        'clients': args.clients,
+        'rate': args.rate,
+        'duration': elapsed,
+        'connected': stats.connected,
+        'spawned': stats.spawned,
+        'disconnected': stats.disconnected,
+        'malformed': stats.malformed,
+        'packets_sent_per_sec': stats.packets_sent / elapsed,
+        'packets_received_per_sec': stats.packets_received / elapsed,
+        'bytes_sent_per_sec': stats.bytes_sent / elapsed,
+        'bytes_received_per_sec': stats.bytes_received / elapsed,
+        'latency_samples': len(stats.latencies),
+        'latency_p50_ms': percentile(stats.latencies, 0.5) * 1000.0,
+        'latency_p90_ms': percentile(stats.latencies, 0.9) * 1000.0,
+        'latency_p99_ms': percentile(stats.latencies, 0.99) * 1000.0,
+        'latency_max_ms': max(stats.latencies or [0.0]) * 1000.0,
+    }
+
+    if server_usage:
+        cpu, rss = get_process_usage(server_pid)
+
+        report['server_cpu_percent'] = (cpu - server_usage[0]) / elapsed * 100.0
+        report['server_rss_mb'] = rss / (1024.0 * 1024.0)
+
+        # how the server's cpu time was split between its worker processes
+        children_percent = [round((cpu - children_cpu.get(child_pid, 0.0)) / elapsed * 100.0, 1)
+            for child_pid, cpu in sorted(get_children_cpu(server_pid).items())]
+
+        if children_percent:
+            report['server_children_cpu_percent'] = children_percent
+
+    if server:
+        server.terminate()
+        server.wait()
+
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless bot load generator for the Syndicate server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10000)
+    parser.add_argument('--map', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets/Maps/test.tmx'),
+        help='the map the server validates moves against, an empty path to walk anywhere')
+    parser.add_argument('--clients', type=int, default=500,
+        help='number of simulated clients')
+    parser.add_argument('--rate', type=float, default=20.0,
+        help='position updates sent per second by every client')
+    parser.add_argument('--duration', type=float, default=30.0,
+        help='seconds to keep every client running after the ramp up')
+    parser.add_argument('--ramp', type=float, default=5.0,
+        help='seconds over which the clients connect')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+        help='processes the clients are spread over')
+    parser.add_argument('--server-pid', type=int,
+        help='pid of a running server to sample cpu and memory usage from')
+    parser.add_argument('--launch-server', metavar='ARGS', nargs='?', const='',
+        help='start server.py for the run, optionally with arguments: --launch-server="--selector" or "--shards 4"')
+    parser.add_argument('--json', metavar='FILE',
+        help='also write the report to FILE as json')
+
+    args = parser.parse_args()
+    report = run(args)
+
+    for name in sorted(report):
+        print('%-26s %s' % (name, round(report[name], 3) if isinstance(report[name], float) else report[name]))
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=4, sort_keys=True)
@@ -2,71 +2,361 @@ import os
 import time
 import pygame
 import random
+import threading
+import glob
 import pyscroll
+import util
 import client
-import __builtin__
+import mapcompiler
+import collision
+import pathfinding
+import argparse
+import collections
+
+try:
+    import __builtin__
+except ImportError:
+    import builtins as __builtin__
+
 from pygame.locals import *
+from metrics import metrics
 from PIL import Image
+from multiprocessing.pool import ThreadPool
 from pytmx.util_pygame import load_pygame
 
 class GameUtil(object):
 
     @staticmethod
     def load_image(filepath):
+        return asset_cache.load_image(filepath)
+
+    @staticmethod
+    def decode_image(filepath):
         if not os.path.exists(filepath):
             raise IOError('Failed to load image file %s!' % filepath)
 
-        image = Image.open(filepath)
-        return pygame.image.fromstring(image.tobytes(), image.size, image.mode).convert_alpha()
+        try:
+            surface = pygame.image.load(filepath)
+        except pygame.error:
+            # pygame was built without support for this format, decode it through PIL instead
+            image = Image.open(filepath)
+            surface = pygame.image.fromstring(image.tobytes(), image.size, image.mode)
+
+        return surface.convert_alpha()
 
     @staticmethod
     def load_map(filepath):
         if not os.path.exists(filepath):
             raise IOError('Failed to load map file %s!' % filepath)
 
+        # compiled maps are memory mapped, skipping the tmx and tsx parsing entirely
+        if filepath.endswith(mapcompiler.MAP_EXTENSION):
+            return mapcompiler.CompiledMap(filepath, GameUtil.load_image)
+
         return load_pygame(filepath)
 
+class GameAssetCache(object):
+
+    def __init__(self):
+        self.surfaces = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.surfaces)}
+
+    def load_image(self, filepath):
+        if not os.path.exists(filepath):
+            raise IOError('Failed to load image file %s!' % filepath)
+
+        # surfaces are keyed by their path and modification time, so an
+        # asset that changed on disk is decoded again instead of going stale
+        path = os.path.abspath(filepath)
+        mtime = os.path.getmtime(path)
+
+        with self.lock:
+            if path in self.surfaces and self.surfaces[path][0] == mtime:
+                self.hits += 1
+                self.update_gauges()
+                return self.surfaces[path][1]
+
+            self.misses += 1
+
+        # decode outside of the lock so warming can run on several threads at once
+        surface = GameUtil.decode_image(path)
+
+        with self.lock:
+            self.surfaces[path] = (mtime, surface)
+            self.update_gauges()
+
+        return surface
+
+    def update_gauges(self):
+        # published as metrics, so they show up in the overlay and the metrics export
+        for name, value in self.stats.items():
+            metrics.set_gauge('assets.%s' % name, value)
+
+    def warm(self, filepaths, workers=4):
+        pool = ThreadPool(workers)
+        result = pool.map_async(self.load_image, filepaths)
+        pool.close()
+
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.surfaces.clear()
+            self.hits = 0
+            self.misses = 0
+            self.update_gauges()
+
+asset_cache = GameAssetCache()
+
 class GameLevel(object):
 
-    def __init__(self, map_filepath):
+    def __init__(self, map_filepath, screen_size=(800, 600)):
+        self.map_filepath = map_filepath
         self.tmx_data = GameUtil.load_map(map_filepath)
-        self.map_data = pyscroll.TiledMapData(self.tmx_data)
+        self.compiled = isinstance(self.tmx_data, mapcompiler.CompiledMap)
+        self.map_data = None if self.compiled else pyscroll.TiledMapData(self.tmx_data)
+        self.screen_size = screen_size
         self.surfacedata = {}
+        self.tiledata = []
+        self.culling = True
+        self.chunking = True
+        self.chunks = GameLevelChunkCache(self)
         self.camera = GameLevelCamera(self)
 
+        # a compiled map carries its grid, a tmx map is parsed for it
+        if self.compiled:
+            self.walkability = collision.WalkabilityGrid.from_compiled(self.tmx_data)
+        else:
+            self.walkability = collision.load_walkability(map_filepath)
+        self.pathfinder = pathfinding.PathfindingService(self.walkability) if self.walkability else None
+
+    @property
+    def tile_size(self):
+        return self.tmx_data.tilewidth, self.tmx_data.tileheight
+
     def setup(self):
-        for x in range(0, self.tmx_data.width):
-            for y in range(0, self.tmx_data.height):
-                for layer in range(0, len(self.tmx_data.layers)):
-                    surface = self.tmx_data.get_tile_image(x, y, layer)
+        # a per layer grid of tile surfaces indexed by [y][x], this is what the
+        # culling renderer uses to look up only the tiles that are on screen.
+        # rows are filled in from the map the first time they're drawn, so a
+        # compiled map loads without a pass over every tile
+        self.tiledata = [[None] * self.tmx_data.height for layer in range(len(self.tmx_data.layers))]
+        self.surfacedata = {}
+
+    def get_tile_row(self, layer, y):
+        row = self.tiledata[layer][y]
+
+        if row is None:
+            get_tile_image = self.tmx_data.get_tile_image
+            row = self.tiledata[layer][y] = [get_tile_image(x, y, layer) or None for x in range(self.tmx_data.width)]
+
+        return row
 
-                    if not surface:
+    def setup_surfacedata(self):
+        # every tile of the map with its position, only the draw everything renderer needs this
+        for layer in range(len(self.tiledata)):
+            for y in range(self.tmx_data.height):
+                for x, surface in enumerate(self.get_tile_row(layer, y)):
+                    if surface is None:
                         continue
 
                     rect = surface.get_rect()
-                    width = rect.width
-                    height = rect.height
-
-                    self.surfacedata[len(self.surfacedata) + 1] = [surface, x * width, y * height]
+                    self.surfacedata[len(self.surfacedata) + 1] = [surface, x * rect.width, y * rect.height]
 
     def update(self):
         pass
 
+    def get_visible_range(self, screen_size=None):
+        screen_width, screen_height = screen_size or self.screen_size
+        tile_width, tile_height = self.tile_size
+        offset_x, offset_y = self.camera.offset
+
+        # the range of tiles touching the screen, clamped to the map's bounds
+        start_x = max(0, int(offset_x // tile_width))
+        start_y = max(0, int(offset_y // tile_height))
+        end_x = min(self.tmx_data.width, int((offset_x + screen_width) // tile_width) + 1)
+        end_y = min(self.tmx_data.height, int((offset_y + screen_height) // tile_height) + 1)
+
+        return start_x, start_y, end_x, end_y
+
     def draw(self, draw_surface):
+        if self.chunking:
+            return self.draw_chunks(draw_surface)
+        elif self.culling:
+            return self.draw_culled(draw_surface)
+
+        return self.draw_all(draw_surface)
+
+    def draw_chunks(self, draw_surface):
+        offset_x, offset_y = self.camera.offset
+        chunk_width, chunk_height = self.chunks.chunk_pixel_size
+        start_x, start_y, end_x, end_y = self.get_visible_range(draw_surface.get_size())
+
+        chunk_size = self.chunks.chunk_size
+        blit = draw_surface.blit
+        blits = 0
+
+        for chunk_y in range(start_y // chunk_size, (end_y - 1) // chunk_size + 1):
+            for chunk_x in range(start_x // chunk_size, (end_x - 1) // chunk_size + 1):
+                surface = self.chunks.get(chunk_x, chunk_y)
+
+                if surface is None:
+                    continue
+
+                blit(surface, (chunk_x * chunk_width - offset_x, chunk_y * chunk_height - offset_y))
+                blits += 1
+
+        return blits
+
+    def draw_culled(self, draw_surface):
+        tile_width, tile_height = self.tile_size
+        offset_x, offset_y = self.camera.offset
+        start_x, start_y, end_x, end_y = self.get_visible_range(draw_surface.get_size())
+
+        blit = draw_surface.blit
+        blits = 0
+
+        for layer in range(len(self.tiledata)):
+            for y in range(start_y, end_y):
+                row = self.get_tile_row(layer, y)
+                draw_y = y * tile_height - offset_y
+
+                for x in range(start_x, end_x):
+                    surface = row[x]
+
+                    if surface is None:
+                        continue
+
+                    blit(surface, (x * tile_width - offset_x, draw_y))
+                    blits += 1
+
+        return blits
+
+    def draw_all(self, draw_surface):
+        offset_x, offset_y = self.camera.offset
+
+        if not self.surfacedata:
+            self.setup_surfacedata()
+
         for surface, x, y in self.surfacedata.values():
-            rect = surface.get_rect()
-            width = rect.width
-            height = rect.height
+            draw_surface.blit(surface, [x - offset_x, y - offset_y])
+
+        return len(self.surfacedata)
+
+class GameLevelChunkCache(object):
+
+    def __init__(self, level, chunk_size=16, memory_budget=32 * 1024 * 1024):
+        self.level = level
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.memory_usage = 0
+        self.chunks = collections.OrderedDict()
+
+    @property
+    def chunk_pixel_size(self):
+        tile_width, tile_height = self.level.tile_size
+        return self.chunk_size * tile_width, self.chunk_size * tile_height
+
+    def get(self, chunk_x, chunk_y):
+        key = (chunk_x, chunk_y)
+
+        if key in self.chunks:
+            # move the chunk to the end of the queue, marking it as most recently used
+            surface = self.chunks.pop(key)
+            self.chunks[key] = surface
+
+            return surface
+
+        surface = self.bake(chunk_x, chunk_y)
+        self.chunks[key] = surface
+
+        if surface is not None:
+            self.memory_usage += self.get_surface_size(surface)
+
+        self.evict()
+        return surface
+
+    def bake(self, chunk_x, chunk_y):
+        # compiled maps may ship with their chunks already baked
+        if self.level.compiled:
+            filepath = mapcompiler.get_chunk_filepath(self.level.map_filepath, self.chunk_size, chunk_x, chunk_y)
+
+            if os.path.exists(filepath):
+                return GameUtil.decode_image(filepath)
+
+        return self.bake_tiles(chunk_x, chunk_y)
+
+    def bake_tiles(self, chunk_x, chunk_y):
+        tile_width, tile_height = self.level.tile_size
+        start_x, start_y = chunk_x * self.chunk_size, chunk_y * self.chunk_size
+        end_x = min(self.level.tmx_data.width, start_x + self.chunk_size)
+        end_y = min(self.level.tmx_data.height, start_y + self.chunk_size)
+
+        surface = None
+
+        for layer in range(len(self.level.tiledata)):
+            for y in range(start_y, end_y):
+                row = self.level.get_tile_row(layer, y)
+
+                for x in range(start_x, end_x):
+                    tile_surface = row[x]
+
+                    if tile_surface is None:
+                        continue
+
+                    # only allocate chunks that actually contain tiles
+                    if surface is None:
+                        surface = pygame.Surface(self.chunk_pixel_size, pygame.SRCALPHA).convert_alpha()
 
-            draw_surface.blit(surface, [x - self.camera.x * 2, y - self.camera.y * 2])
+                    surface.blit(tile_surface, ((x - start_x) * tile_width, (y - start_y) * tile_height))
+
+        return surface
+
+    def evict(self):
+        # never evict the chunk that was just added, even if it alone exceeds the budget
+        while self.memory_usage > self.memory_budget and len(self.chunks) > 1:
+            key, surface = self.chunks.popitem(last=False)
+
+            if surface is not None:
+                self.memory_usage -= self.get_surface_size(surface)
+
+    def clear(self):
+        self.chunks.clear()
+        self.memory_usage = 0
+
+    @staticmethod
+    def get_surface_size(surface):
+        width, height = surface.get_size()
+        return width * height * surface.get_bytesize()
 
 class GameLevelCamera(object):
 
     def __init__(self, level):
         self.level = level
+
+        # the map position in the middle of the screen
         self.x = 0
         self.y = 0
 
+    @property
+    def offset(self):
+        # the map position of the screen's top left corner, everything is drawn shifted by it
+        screen_width, screen_height = self.level.screen_size
+        return int(self.x) - screen_width // 2, int(self.y) - screen_height // 2
+
+    def to_screen(self, x, y):
+        offset_x, offset_y = self.offset
+        return int(x) - offset_x, int(y) - offset_y
+
+    def to_map(self, x, y):
+        offset_x, offset_y = self.offset
+        return x + offset_x, y + offset_y
+
 class Delayer(object):
 
     def __init__(self, function, delay):
@@ -93,55 +383,38 @@ class PlayerAnimator(object):
     WALK_LEFT = 'walk_left'
     WALK_RIGHT = 'walk_right'
 
+    # the walk sheet row and frame range used by each animation state
+    STATE_FRAMES = {
+        IDLE: (0, range(0, 2)),
+        WALK_FORWARD: (0, range(2, 9)),
+        WALK_BACKWARD: (2, range(0, 9)),
+        WALK_LEFT: (1, range(0, 9)),
+        WALK_RIGHT: (3, range(0, 9)),
+    }
+
+    # animation frames are shared by every animator in the process,
+    # they are only loaded from disk the first time a player is created
+    shared_state_dict = None
+    shared_state_lock = threading.Lock()
+
+    @classmethod
+    def load_state_dict(cls):
+        with cls.shared_state_lock:
+            if cls.shared_state_dict is not None:
+                return cls.shared_state_dict
+
+            state_dict = {}
+
+            for state, (row, frames) in cls.STATE_FRAMES.items():
+                state_dict[state] = dict((index + 1, GameUtil.load_image(
+                    'assets/Characters/Agent/Walk/walk-%d-%d.png' % (row, frame)))
+                    for index, frame in enumerate(frames))
+
+            cls.shared_state_dict = state_dict
+            return state_dict
+
     def __init__(self):
-        self.state_dict = {
-            self.IDLE: {
-                1: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-0.png'),
-                2: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-1.png'),
-            },
-            self.WALK_FORWARD: {
-                1: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-2.png'),
-                2: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-3.png'),
-                3: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-4.png'),
-                4: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-5.png'),
-                5: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-6.png'),
-                6: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-7.png'),
-                7: GameUtil.load_image('assets/Characters/Agent/Walk/walk-0-8.png'),
-            },
-            self.WALK_BACKWARD: {
-                1: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-0.png'),
-                2: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-1.png'),
-                3: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-2.png'),
-                4: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-3.png'),
-                5: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-4.png'),
-                6: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-5.png'),
-                7: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-6.png'),
-                8: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-7.png'),
-                9: GameUtil.load_image('assets/Characters/Agent/Walk/walk-2-8.png'),
-            },
-            self.WALK_LEFT: {
-                1: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-0.png'),
-                2: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-1.png'),
-                3: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-2.png'),
-                4: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-3.png'),
-                5: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-4.png'),
-                6: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-5.png'),
-                7: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-6.png'),
-                8: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-7.png'),
-                9: GameUtil.load_image('assets/Characters/Agent/Walk/walk-1-8.png'),
-            },
-            self.WALK_RIGHT: {
-                1: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-0.png'),
-                2: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-1.png'),
-                3: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-2.png'),
-                4: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-3.png'),
-                5: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-4.png'),
-                6: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-5.png'),
-                7: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-6.png'),
-                8: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-7.png'),
-                9: GameUtil.load_image('assets/Characters/Agent/Walk/walk-3-8.png'),
-            }
-        }
+        self.state_dict = self.load_state_dict()
 
         self.state = self.IDLE
         self.state_index = 1
@@ -166,6 +439,9 @@ class PlayerAnimator(object):
         self.state_delay.update()
 
 class Player(pygame.sprite.DirtySprite, PlayerAnimator):
+    SPEED = 60.0 # movement speed in pixels per second
+    snapshot_interval = 1.0 / 20 # the server's tick interval, until the server announces its tick rate
+    interpolation_delay = 0.1 # how far behind the server remote players are rendered, two tick intervals
 
     def __init__(self, id, owner=False):
         pygame.sprite.DirtySprite.__init__(self)
@@ -180,15 +456,46 @@ class Player(pygame.sprite.DirtySprite, PlayerAnimator):
         self.last_x = 0
         self.last_y = 0
 
+        # the position at the start of the last simulation step and the
+        # position the player is rendered at, interpolated between the two
+        self.previous_x = None
+        self.previous_y = None
+
+        self.render_x = 0
+        self.render_y = 0
+
+        # timestamped server positions of a remote player, rendered interpolated a fixed delay behind
+        self.snapshots = collections.deque(maxlen=32)
+
+        # the last position the server sent for our own player, reconciled on the next update
+        self.server_position = None
+
+        # the positions left to walk to after a click, and the path search that is still running
+        self.path = collections.deque()
+        self.path_request = None
+
+    @classmethod
+    def set_tick_rate(cls, tick_rate):
+        cls.snapshot_interval = 1.0 / tick_rate
+
+        # two snapshots behind, so a single late snapshot doesn't stall remote players
+        cls.interpolation_delay = 2 * cls.snapshot_interval
+
+    def play(self):
+        PlayerAnimator.play(self)
+
+        # the animation frame changed, redraw this sprite on the next dirty update
+        self.dirty = 1
+
     @property
     def image(self):
         return self.state_surface
 
     @property
     def rect(self):
+        # where the player is drawn on the screen
         rect = self.state_surface.get_rect()
-        rect.x = self.x
-        rect.y = self.y
+        rect.topleft = level.camera.to_screen(self.render_x, self.render_y)
 
         return rect
 
@@ -198,8 +505,10 @@ class Player(pygame.sprite.DirtySprite, PlayerAnimator):
 
     @x.setter
     def x(self, x):
+        if x != self._x:
+            self.dirty = 1
+
         self._x = x
-        self.rect.x = x
 
     @property
     def y(self):
@@ -207,17 +516,27 @@ class Player(pygame.sprite.DirtySprite, PlayerAnimator):
 
     @y.setter
     def y(self, y):
+        if y != self._y:
+            self.dirty = 1
+
         self._y = y
-        self.rect.y = y
 
     def get_key_control(self):
         key = pygame.key.get_pressed()
 
         return [key[pygame.K_DOWN], key[pygame.K_UP], key[pygame.K_RIGHT], key[pygame.K_LEFT]]
 
-    def update(self):
+    def update(self, dt):
+        self.previous_x = self.x
+        self.previous_y = self.y
+
         if self.owner:
-            self.update_input()
+            if self.server_position:
+                self.reconcile()
+
+            self.update_input(dt)
+        else:
+            self.update_snapshots()
 
         if self.x < self.last_x:
             self.state = self.WALK_LEFT
@@ -235,68 +554,291 @@ class Player(pygame.sprite.DirtySprite, PlayerAnimator):
 
         PlayerAnimator.update(self)
 
-    def update_input(self):
-        key = pygame.key.get_pressed()
-        speed = 1.0
+    def add_snapshot(self, timestamp, x, y):
+        # the server only sends positions that changed, after a pause hold the last
+        # position until a tick before this one instead of gliding through the pause
+        if self.snapshots and timestamp - self.snapshots[-1][0] > self.snapshot_interval * 1.5:
+            last_timestamp, last_x, last_y = self.snapshots[-1]
+            self.snapshots.append((timestamp - self.snapshot_interval, last_x, last_y))
+
+        self.snapshots.append((timestamp, x, y))
+
+    def update_snapshots(self):
+        render_time = time.time() - self.interpolation_delay
+        snapshots = self.snapshots
+
+        # drop the snapshots that are older than the two around the render time
+        while len(snapshots) >= 2 and snapshots[1][0] <= render_time:
+            snapshots.popleft()
+
+        if not snapshots:
+            return
+
+        timestamp, x, y = snapshots[0]
+
+        if len(snapshots) == 1 or render_time <= timestamp:
+            self.x, self.y = x, y
+            return
+
+        next_timestamp, next_x, next_y = snapshots[1]
+        alpha = (render_time - timestamp) / (next_timestamp - timestamp)
+
+        self.x = x + (next_x - x) * alpha
+        self.y = y + (next_y - y) * alpha
+
+    def reconcile(self):
+        x, y = self.server_position
+        self.server_position = None
+
+        acknowledged, position = client.acknowledge_position(x, y)
+
+        # the server accepted a position we sent, our prediction holds
+        if acknowledged:
+            return
+
+        # the server corrected us, replay the moves we made since our
+        # first unacknowledged position on top of its position
+        if position:
+            x += self.x - position[0]
+            y += self.y - position[1]
+
+        self.x = x
+        self.y = y
+
+    def move_to(self, x, y):
+        if not level.pathfinder:
+            return
+
+        walkability = level.walkability
+
+        # walk until the player's feet are on the tile that was clicked
+        start = walkability.get_box_tile(self.x, self.y)
+        goal = int(x // walkability.tile_width), int(y // walkability.tile_height)
+
+        self.path.clear()
+        self.path_request = level.pathfinder.request(start, goal)
+
+    def get_path_step(self, speed):
+        if self.path_request and self.path_request.done:
+            self.path = collections.deque(level.walkability.get_box_position(*tile) for tile in self.path_request.path)
+            self.path_request = None
+
+        if not self.path:
+            return 0, 0
+
+        target_x, target_y = self.path[0]
+        dx, dy = target_x - self.x, target_y - self.y
+        distance = max(abs(dx), abs(dy))
+
+        if distance <= speed:
+            self.path.popleft()
+            return dx, dy
+
+        # the path only goes straight or diagonally, so this keeps the same speed as the arrow keys
+        return dx * speed / distance, dy * speed / distance
+
+    def update_input(self, dt):
+        speed = self.SPEED * dt
 
         (down, up, right, left) = self.get_key_control()
 
-        if down:
-            self.y += speed
+        dx = (right - left) * speed
+        dy = (down - up) * speed
 
-        if up:
-            self.y -= speed
+        # the arrow keys take over from a click
+        if dx or dy:
+            self.path.clear()
+            self.path_request = None
+        else:
+            dx, dy = self.get_path_step(speed)
 
-        if right:
-            self.x += speed
+        # slide along whatever blocks the move, the server rejects moves through it
+        if level.walkability:
+            x, y = level.walkability.move(self.x, self.y, dx, dy)
 
-        if left:
-            self.x -= speed
+            # something got in the way of the path, stop instead of pushing against it
+            if (dx or dy) and (x, y) == (self.x, self.y):
+                self.path.clear()
 
-        level.camera.x = self.x
-        level.camera.y = self.y
+            self.x, self.y = x, y
+        else:
+            self.x += dx
+            self.y += dy
 
         # now broadcast a position update for this player
         client.handle_send_position_update(self)
 
+    def interpolate(self, alpha):
+        if self.previous_x is None:
+            render_x, render_y = self.x, self.y
+        else:
+            render_x = self.previous_x + (self.x - self.previous_x) * alpha
+            render_y = self.previous_y + (self.y - self.previous_y) * alpha
+
+        if render_x != self.render_x or render_y != self.render_y:
+            self.dirty = 1
+
+        self.render_x = render_x
+        self.render_y = render_y
+
+        # the camera centres on where the owned player is drawn, not where it is simulated
+        if self.owner:
+            level.camera.x = render_x + self.state_surface.get_width() // 2
+            level.camera.y = render_y + self.state_surface.get_height() // 2
+
+    def draw(self, surface):
+        surface.blit(self.state_surface, level.camera.to_screen(self.render_x, self.render_y))
+
+class DirtyRenderer(object):
+
+    def __init__(self, level, screen):
+        self.level = level
+        self.screen = screen
+        self.background = pygame.Surface(screen.get_size()).convert()
+        self.group = pygame.sprite.LayeredDirty()
+        self.camera_offset = None
+        self.blits = 0
+
+    def update_background(self):
+        offset = self.level.camera.offset
+
+        if offset == self.camera_offset:
+            return False
+
+        self.camera_offset = offset
+
+        self.background.fill(pygame.Color(1, 1, 1, 1))
+        self.blits += self.level.draw(self.background)
+
+        return True
+
+    def update_sprites(self, sprites):
+        for sprite in self.group.sprites():
+            if sprite not in sprites:
+                self.group.remove(sprite)
+
+        for sprite in sprites:
+            if not self.group.has(sprite):
+                self.group.add(sprite)
+
+    def draw(self, sprites, overlay=None):
+        self.update_sprites(sprites)
+        self.blits = 0
+
+        # the camera scrolled, so the whole screen has to be repainted
+        if self.update_background():
+            self.group.repaint_rect(self.screen.get_rect())
+
+        # the overlay isn't a sprite, repaint whatever it covered last frame
+        if overlay and overlay.rect:
+            self.group.repaint_rect(overlay.rect)
+
+            if not overlay.enabled:
+                overlay.rect = None
+
+        rects = self.group.draw(self.screen, self.background)
+        self.blits += len(rects)
+
+        if overlay and overlay.enabled:
+            rects.append(overlay.draw(self.screen))
+            self.blits += 1
+
+        return rects
+
+class MetricsOverlay(object):
+    REFRESH_INTERVAL = 0.5
+
+    def __init__(self):
+        self.enabled = False
+        self.font = pygame.font.Font(None, 18)
+        self.surface = None
+        self.rect = None
+
+        self.timestamp = 0
+        self.counters = {}
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.timestamp = 0
+
+    def get_rate(self, name, duration):
+        value = metrics.get_counter(name)
+        rate = (value - self.counters.get(name, value)) / duration
+        self.counters[name] = value
+
+        return rate
+
+    def get_lines(self, duration):
+        lines = ['fps %.1f' % clock.get_fps()]
+
+        for name in ('update', 'draw', 'flip'):
+            histogram = metrics.get_histogram('frame.%s_ms' % name)
+            lines.append('%-6s %6.2f ms  p90 %g ms' % (name, histogram.last, histogram.percentile(0.9)))
+
+        lines.append('blits %d' % metrics.get_gauge('frame.blits'))
+        lines.append('packets in %d/s out %d/s' % (self.get_rate('net.packets_in', duration),
+            self.get_rate('net.packets_out', duration)))
+        lines.append('bytes in %d/s out %d/s' % (self.get_rate('net.bytes_in', duration),
+            self.get_rate('net.bytes_out', duration)))
+        lines.append('send queue %d' % metrics.get_gauge('net.send_queue'))
+        lines.append('assets %d hits %d misses %d cached' % (metrics.get_gauge('assets.hits'),
+            metrics.get_gauge('assets.misses'), metrics.get_gauge('assets.size')))
+
+        return lines
+
+    def update(self):
+        # rendering text every frame would show up in the very numbers it displays
+        now = time.time()
+        duration = now - self.timestamp
+
+        if duration < self.REFRESH_INTERVAL and self.surface:
+            return
+
+        self.timestamp = now
+
+        lines = [self.font.render(line, True, pygame.Color(255, 255, 255)) for line in self.get_lines(duration)]
+        line_height = self.font.get_linesize()
+
+        self.surface = pygame.Surface((max(line.get_width() for line in lines) + 8, len(lines) * line_height + 8))
+        self.surface.set_alpha(192)
+
+        for index, line in enumerate(lines):
+            self.surface.blit(line, (4, 4 + index * line_height))
+
     def draw(self, surface):
-        surface.blit(self.state_surface, (self.x, self.y))
+        self.update()
+        self.rect = surface.blit(self.surface, (0, 0))
+
+        return self.rect
 
 class MousePicker(object):
 
     def __init__(self):
-        self.moving = False
+        self.was_pressed = False
 
     @property
     def xy(self):
         if not pygame.mouse.get_focused():
-            return [0, 0]
-
-        x, y = pygame.mouse.get_pos()
+            return None
 
-        return [x / level.tmx_data.width, y / level.tmx_data.height]
+        # the map position under the cursor
+        return list(level.camera.to_map(*pygame.mouse.get_pos()))
 
     @property
     def pressed(self):
         return pygame.mouse.get_pressed()
 
     def update(self):
-        m_x, m_y = self.xy
-
-        m_x *= level.tmx_data.width
-        m_y *= level.tmx_data.height
-
         (btn1, btn2, btn3) = self.pressed
+        xy = self.xy
 
-        if not btn1 and self.moving:
-            self.moving = False
+        # click to move, the player walks a path to the clicked tile
+        if btn1 and not self.was_pressed and xy:
+            client.owned_player.move_to(*xy)
 
-        if round(m_x) - round(client.owned_player.x) <= 5 and round(m_y) - round(client.owned_player.y) <= 5 and btn1 or self.moving:
-            client.owned_player.x = m_x
-            client.owned_player.y = m_y
-            self.moving = True
+        self.was_pressed = btn1
 
-def main():
+def main(map_filepath='assets/Maps/test.tmx', dirty_rendering=False, fps=60, tick_rate=60, metrics_filepath=None):
     pygame.init()
 
     screen_height, screen_width = 800, 600
@@ -307,8 +849,11 @@ def main():
     global screen
     screen = pygame.display.set_mode([screen_height, screen_width])
 
+    # decode the player animation frames in the background while the map loads
+    asset_cache.warm(glob.glob('assets/Characters/Agent/Walk/*.png'))
+
     global level
-    level = GameLevel('assets/Maps/test.tmx')
+    level = GameLevel(map_filepath, [screen_height, screen_width])
     level.setup()
 
     __builtin__.level = level
@@ -334,36 +879,136 @@ def main():
     global mouse_picker
     mouse_picker = MousePicker()
 
-    # setup the client networking loop
+    # only redraw the regions touched by moving players or a camera scroll
+    dirty_renderer = DirtyRenderer(level, screen) if dirty_rendering else None
+
+    # toggled with F3
+    overlay = MetricsOverlay()
+
+    # connect to the server and setup the client networking loop
+    client.connect()
     client.run_mainloop()
 
     # finally request a new player object over the network
     client.handle_send_request_spawn()
 
-    while True:
+    # the simulation runs at a fixed timestep, independent from the render rate
+    timestep = 1.0 / tick_rate
+    accumulator = 0.0
+
+    running = True
+
+    while running:
         for event in pygame.event.get():
             if event.type == QUIT:
-                break
+                running = False
+            elif event.type == KEYDOWN and event.key == K_F3:
+                overlay.toggle()
+
+        # clocks pygame to render at the target fps, a value of zero leaves it uncapped
+        frame_time = clock.tick(fps) / 1000.0
+
+        # clamp long frames (window drags, breakpoints...) so the simulation
+        # doesn't have to run hundreds of steps to catch up
+        accumulator += min(frame_time, 0.25)
+
+        frame_start = time.time()
 
-        screen.fill(pygame.Color(1, 1, 1, 1))
+        while accumulator >= timestep:
+            level.update()
 
-        level.update()
-        level.draw(screen)
+            for player in list(players.values()):
+                player.update(timestep)
+
+            # only update mouse picker if we have a player
+            if client.owned_player:
+                mouse_picker.update()
+
+            accumulator -= timestep
+
+        # how far we are into the next simulation step, used to smooth rendering
+        alpha = accumulator / timestep
 
         for player in list(players.values()):
-            player.update()
-            player.draw(screen)
+            player.interpolate(alpha)
+
+        draw_start = time.time()
+
+        if dirty_renderer:
+            rects = dirty_renderer.draw(list(players.values()), overlay)
+            blits = dirty_renderer.blits
+        else:
+            screen.fill(pygame.Color(1, 1, 1, 1))
+            blits = level.draw(screen)
+
+            for player in list(players.values()):
+                player.draw(screen)
+                blits += 1
+
+            #player_group.draw(screen)
+
+            if overlay.enabled:
+                overlay.draw(screen)
+                blits += 1
+
+        flip_start = time.time()
+
+        if not dirty_renderer:
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update(rects)
+
+        frame_end = time.time()
 
-        # only update mouse picker if we have a player
-        #if client.owned_player:
-        #    mouse_picker.update()
+        metrics.record('frame.update_ms', (draw_start - frame_start) * 1000.0)
+        metrics.record('frame.draw_ms', (flip_start - draw_start) * 1000.0)
+        metrics.record('frame.flip_ms', (frame_end - flip_start) * 1000.0)
+        metrics.record('frame.total_ms', frame_time * 1000.0)
+        metrics.set_gauge('frame.blits', blits)
 
-        #player_group.draw(screen)
+    if metrics_filepath:
+        metrics.dump(metrics_filepath)
 
-        pygame.display.flip()
-        # clocks pygame to render at 60fps
-        #clock.tick(60)
-        #print (clock.get_fps())
+    pygame.quit()
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Syndicate game client')
+    parser.add_argument('--map', default='assets/Maps/test.tmx',
+        help='the tmx or compiled map to play on')
+    parser.add_argument('--dirty-rendering', action='store_true',
+        help='only redraw the regions of the screen that changed')
+    parser.add_argument('--fps', type=int, default=60,
+        help='maximum frames rendered per second, 0 for uncapped')
+    parser.add_argument('--tick-rate', type=int, default=60,
+        help='simulation steps per second')
+    parser.add_argument('--send-rate', type=int, default=client.send_rate,
+        help='position updates sent to the server per second')
+    parser.add_argument('--udp', action='store_true',
+        help='send and receive positions over udp, the server has to run with --udp too')
+    parser.add_argument('--udp-loss', type=float, default=0.0,
+        help='emulated loss rate of udp datagrams in both directions, between 0 and 1')
+    parser.add_argument('--udp-latency', type=float, default=0.0,
+        help='emulated one way latency of udp datagrams in seconds')
+    parser.add_argument('--udp-jitter', type=float, default=0.0,
+        help='emulated latency jitter of udp datagrams in seconds')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='dump the frame and network metrics to FILE as json when the game exits')
+    parser.add_argument('--metrics-port', type=int,
+        help='serve the frame and network metrics as json over http on localhost')
+
+    args = parser.parse_args()
+
+    # both are turned into the interval between two steps or two updates
+    if args.send_rate <= 0 or args.tick_rate <= 0:
+        parser.error('--send-rate and --tick-rate have to be above 0')
+
+    client.send_rate = args.send_rate
+    client.udp_enabled = args.udp
+
+    if args.udp_loss or args.udp_latency or args.udp_jitter:
+        client.udp_emulator = util.NetworkEmulator(args.udp_loss, args.udp_latency, args.udp_jitter)
+
+    if args.metrics_port:
+        metrics.serve(port=args.metrics_port)
+
+    main(args.map, args.dirty_rendering, args.fps, args.tick_rate, args.metrics)
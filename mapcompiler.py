@@ -0,0 +1,360 @@
+import os
+import sys
+import mmap
+import zlib
+import gzip
+import base64
+import bisect
+import argparse
+import xml.etree.ElementTree as ElementTree
+
+from array import array
+from io import BytesIO
+from struct import Struct, calcsize
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAP_MAGIC = b'SYNM'
+MAP_VERSION = 2
+MAP_EXTENSION = '.synmap'
+
+# the tiled gid flags stored in the upper bits of every gid
+GID_FLIPPED_HORIZONTALLY = 0x80000000
+GID_FLIPPED_VERTICALLY = 0x40000000
+GID_FLIPPED_DIAGONALLY = 0x20000000
+GID_MASK = 0x1FFFFFFF
+
+# magic, version, width, height, tile width, tile height, tileset count, layer count
+header_struct = Struct('<4sBHHHHBB')
+
+# first gid, tile count, columns, tile width, tile height, spacing, margin
+tileset_struct = Struct('<IIHHHHH')
+
+string_struct = Struct('<H')
+offset_struct = Struct('<I')
+
+def array_frombytes(values, data):
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+
+    # grids are always stored as little endian
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+def array_tobytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+def pack_string(value):
+    value = value.encode('utf-8')
+    return string_struct.pack(len(value)) + value
+
+def unpack_string(data, offset):
+    length, = string_struct.unpack_from(data, offset)
+    offset += string_struct.size
+
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+def parse_layer_data(element):
+    encoding = element.get('encoding')
+    compression = element.get('compression')
+
+    if element.find('chunk') is not None:
+        raise ValueError('Infinite maps are not supported!')
+
+    if encoding == 'csv':
+        return [int(gid) for gid in element.text.replace('\n', '').split(',') if gid.strip()]
+
+    elif encoding == 'base64':
+        data = base64.b64decode(element.text.strip())
+
+        if compression == 'zlib':
+            data = zlib.decompress(data)
+        elif compression == 'gzip':
+            data = gzip.GzipFile(fileobj=BytesIO(data)).read()
+        elif compression:
+            raise ValueError('Unsupported layer compression %s!' % compression)
+
+        # tiled stores base64 gids as little endian too
+        return list(array_frombytes(array('I'), data))
+
+    elif encoding is None:
+        return [int(tile.get('gid', 0)) for tile in element.findall('tile')]
+
+    raise ValueError('Unsupported layer encoding %s!' % encoding)
+
+def parse_tileset(element, map_dirpath, output_dirpath):
+    firstgid = int(element.get('firstgid'))
+    tileset_dirpath = map_dirpath
+
+    # external tilesets only keep their first gid in the map file
+    if element.get('source'):
+        tileset_filepath = os.path.join(map_dirpath, element.get('source'))
+        tileset_dirpath = os.path.dirname(tileset_filepath)
+        element = ElementTree.parse(tileset_filepath).getroot()
+
+    image = element.find('image')
+
+    if image is None:
+        raise ValueError('Image collection tilesets are not supported!')
+
+    tile_width = int(element.get('tilewidth'))
+    tile_height = int(element.get('tileheight'))
+    spacing = int(element.get('spacing', 0))
+    margin = int(element.get('margin', 0))
+
+    image_width = int(image.get('width'))
+    columns = int(element.get('columns', (image_width - margin * 2 + spacing) // (tile_width + spacing)))
+    tile_count = int(element.get('tilecount', 0))
+
+    # store the image path relative to the compiled map, so they can be moved together
+    image_filepath = os.path.normpath(os.path.join(tileset_dirpath, image.get('source')))
+    image_filepath = os.path.relpath(image_filepath, output_dirpath).replace(os.sep, '/')
+
+    return (firstgid, tile_count, columns, tile_width, tile_height, spacing, margin), image_filepath
+
+def compile_map(tmx_filepath, output_filepath=None):
+    if not os.path.exists(tmx_filepath):
+        raise IOError('Failed to load map file %s!' % tmx_filepath)
+
+    if not output_filepath:
+        output_filepath = os.path.splitext(tmx_filepath)[0] + MAP_EXTENSION
+
+    map_dirpath = os.path.dirname(os.path.abspath(tmx_filepath))
+    output_dirpath = os.path.dirname(os.path.abspath(output_filepath))
+
+    root = ElementTree.parse(tmx_filepath).getroot()
+
+    if root.get('orientation', 'orthogonal') != 'orthogonal':
+        raise ValueError('Only orthogonal maps are supported!')
+
+    width, height = int(root.get('width')), int(root.get('height'))
+    tile_width, tile_height = int(root.get('tilewidth')), int(root.get('tileheight'))
+
+    tilesets = [parse_tileset(element, map_dirpath, output_dirpath) for element in root.findall('tileset')]
+    layers = [(element.get('name', ''), parse_layer_data(element.find('data')))
+        for element in root.findall('layer')]
+
+    for name, gids in layers:
+        if len(gids) != width * height:
+            raise ValueError('Layer %s has %d tiles, expected %d!' % (name, len(gids), width * height))
+
+    # the walkability grid is built from the tileset names and tile properties, which aren't
+    # kept in the compiled map, so it is compiled along with it instead of parsed at runtime
+    import collision
+    walkability = collision.WalkabilityGrid.from_tmx(tmx_filepath)
+
+    directory = header_struct.pack(MAP_MAGIC, MAP_VERSION, width, height,
+        tile_width, tile_height, len(tilesets), len(layers))
+
+    for tileset, image_filepath in tilesets:
+        directory += tileset_struct.pack(*tileset) + pack_string(image_filepath)
+
+    # the layer directory holds an offset to each layer's gid grid, the grids
+    # follow the directory aligned to 4 bytes so they can be mapped as uint32 arrays,
+    # the directory ends with the offset of the byte per tile walkability grid after them
+    directory_size = len(directory) + sum(len(pack_string(name)) + offset_struct.size for name, gids in layers)
+    directory_size += offset_struct.size
+    data_offset = (directory_size + 3) & ~3
+    grid_size = width * height * calcsize('<I')
+
+    for index, (name, gids) in enumerate(layers):
+        directory += pack_string(name) + offset_struct.pack(data_offset + index * grid_size)
+
+    directory += offset_struct.pack(data_offset + len(layers) * grid_size)
+
+    with open(output_filepath, 'wb') as output_file:
+        output_file.write(directory)
+        output_file.write(b'\0' * (data_offset - len(directory)))
+
+        for name, gids in layers:
+            output_file.write(array_tobytes(array('I', gids)))
+
+        output_file.write(walkability.cells)
+
+    return output_filepath
+
+def get_chunk_dirpath(map_filepath):
+    return os.path.splitext(map_filepath)[0] + '.chunks'
+
+def get_chunk_filepath(map_filepath, chunk_size, chunk_x, chunk_y):
+    return os.path.join(get_chunk_dirpath(map_filepath), 'chunk-%d-%d-%d.png' % (chunk_size, chunk_x, chunk_y))
+
+def bake_chunks(map_filepath, chunk_size=16):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+    import pygame
+    import main
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+    level = main.GameLevel(map_filepath)
+    level.chunks.chunk_size = chunk_size
+    level.setup()
+
+    if not os.path.exists(get_chunk_dirpath(map_filepath)):
+        os.makedirs(get_chunk_dirpath(map_filepath))
+
+    chunks_x = (level.tmx_data.width + chunk_size - 1) // chunk_size
+    chunks_y = (level.tmx_data.height + chunk_size - 1) // chunk_size
+
+    for chunk_y in range(chunks_y):
+        for chunk_x in range(chunks_x):
+            surface = level.chunks.bake_tiles(chunk_x, chunk_y)
+
+            if surface is None:
+                continue
+
+            pygame.image.save(surface, get_chunk_filepath(map_filepath, chunk_size, chunk_x, chunk_y))
+
+    pygame.quit()
+
+class CompiledMapLayer(object):
+
+    def __init__(self, name, gids):
+        self.name = name
+        self.gids = gids
+
+class CompiledMap(object):
+
+    def __init__(self, filepath, load_image):
+        if not os.path.exists(filepath):
+            raise IOError('Failed to load map file %s!' % filepath)
+
+        self.filepath = filepath
+        self.load_image = load_image
+
+        self.file = open(filepath, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.width, self.height, self.tilewidth, self.tileheight,
+            tileset_count, layer_count) = header_struct.unpack_from(self.data, 0)
+
+        if magic != MAP_MAGIC or version != MAP_VERSION:
+            raise IOError('Map file %s is not a compiled map or is out of date!' % filepath)
+
+        offset = header_struct.size
+        dirpath = os.path.dirname(filepath)
+
+        self.tilesets = []
+
+        for _ in range(tileset_count):
+            tileset = tileset_struct.unpack_from(self.data, offset)
+            image_filepath, offset = unpack_string(self.data, offset + tileset_struct.size)
+
+            self.tilesets.append((tileset, os.path.join(dirpath, image_filepath)))
+
+        self.tilesets.sort(key=lambda tileset: tileset[0][0])
+        self.firstgids = [tileset[0] for tileset, image_filepath in self.tilesets]
+
+        self.layers = []
+
+        for _ in range(layer_count):
+            name, offset = unpack_string(self.data, offset)
+            data_offset, = offset_struct.unpack_from(self.data, offset)
+            offset += offset_struct.size
+
+            self.layers.append(CompiledMapLayer(name, self.map_grid(data_offset)))
+
+        self.walkability_offset, = offset_struct.unpack_from(self.data, offset)
+
+        self.tileset_images = {}
+        self.tile_images = {}
+
+    def map_grid(self, offset):
+        count = self.width * self.height
+
+        # numpy can view the mapped file directly, without copying the grid
+        if numpy is not None:
+            return numpy.frombuffer(self.data, dtype='<u4', count=count, offset=offset)
+
+        # and so can a cast memoryview on python 3, as long as the grid's byte order is ours
+        if hasattr(memoryview, 'cast') and sys.byteorder == 'little' and array('I').itemsize == 4:
+            return memoryview(self.data)[offset:offset + count * 4].cast('I')
+
+        # python 2 reads a copy of the grid out of the mapped file, which costs a pass over it
+        grid = array('I')
+        return array_frombytes(grid, self.data[offset:offset + count * grid.itemsize])
+
+    def get_walkability_cells(self):
+        # a copy, so the grid outlives the mapped file
+        return bytearray(self.data[self.walkability_offset:self.walkability_offset + self.width * self.height])
+
+    def get_tile_gid(self, x, y, layer):
+        return int(self.layers[layer].gids[y * self.width + x])
+
+    def get_tile_image(self, x, y, layer):
+        gid = self.get_tile_gid(x, y, layer)
+
+        if not gid & GID_MASK:
+            return None
+
+        if gid not in self.tile_images:
+            self.tile_images[gid] = self.load_tile_image(gid)
+
+        return self.tile_images[gid]
+
+    def load_tile_image(self, gid):
+        import pygame
+
+        index = bisect.bisect_right(self.firstgids, gid & GID_MASK) - 1
+
+        if index < 0:
+            return None
+
+        (firstgid, tile_count, columns, tile_width, tile_height, spacing, margin), image_filepath = self.tilesets[index]
+
+        if image_filepath not in self.tileset_images:
+            self.tileset_images[image_filepath] = self.load_image(image_filepath)
+
+        tile_id = (gid & GID_MASK) - firstgid
+        x = margin + (tile_id % columns) * (tile_width + spacing)
+        y = margin + (tile_id // columns) * (tile_height + spacing)
+
+        surface = self.tileset_images[image_filepath].subsurface((x, y, tile_width, tile_height))
+
+        # apply the flips the same way pytmx does
+        if gid & GID_FLIPPED_DIAGONALLY:
+            surface = pygame.transform.flip(pygame.transform.rotate(surface, 270), True, False)
+
+        if gid & (GID_FLIPPED_HORIZONTALLY | GID_FLIPPED_VERTICALLY):
+            surface = pygame.transform.flip(surface, bool(gid & GID_FLIPPED_HORIZONTALLY),
+                bool(gid & GID_FLIPPED_VERTICALLY))
+
+        return surface
+
+    def close(self):
+        # the mapped file can't be closed while a grid still views it
+        for layer in self.layers:
+            if isinstance(layer.gids, memoryview):
+                layer.gids.release()
+
+        self.layers = []
+        self.data.close()
+        self.file.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a TMX map into a binary map')
+    parser.add_argument('map', help='the TMX map to compile')
+    parser.add_argument('-o', '--output', help='the compiled map filepath')
+    parser.add_argument('--bake-chunks', type=int, metavar='SIZE', default=0,
+        help='also pre-bake chunk images of SIZE x SIZE tiles')
+
+    args = parser.parse_args()
+    output_filepath = compile_map(args.map, args.output)
+
+    if args.bake_chunks:
+        bake_chunks(output_filepath, args.bake_chunks)
+
+    print('compiled %s to %s' % (args.map, output_filepath))
@@ -0,0 +1,168 @@
+import json
+import time
+import bisect
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# histogram bucket upper bounds, in milliseconds
+DEFAULT_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 12, 16, 20, 25, 33, 50, 100, 250, 1000)
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.last = value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        # only the buckets are kept, so this is the upper bound of the bucket the percentile falls in
+        target = fraction * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+
+            if count and seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+
+        return 0.0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'last': self.last,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': [[bound, count] for bound, count in zip(self.buckets + ('inf',), self.counts)],
+        }
+
+class MetricsTimer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.timestamp = None
+
+    def __enter__(self):
+        self.timestamp = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.record(self.name, (time.time() - self.timestamp) * 1000.0)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        data = json.dumps(self.server.metrics.snapshot(), indent=4, sort_keys=True).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Metrics(object):
+
+    def __init__(self):
+        # counters are incremented from the network threads as well as the main thread
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def record(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+
+            self.histograms[name].record(value)
+
+    def timer(self, name):
+        return MetricsTimer(self, name)
+
+    def get_counter(self, name):
+        return self.counters.get(name, 0)
+
+    def get_gauge(self, name):
+        return self.gauges.get(name, 0)
+
+    def get_histogram(self, name):
+        return self.histograms.get(name) or Histogram()
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.time() - self.started
+
+            return {
+                'uptime': uptime,
+                'counters': dict(self.counters),
+                'rates': dict((name, value / uptime) for name, value in self.counters.items()),
+                'gauges': dict(self.gauges),
+                'histograms': dict((name, histogram.to_dict()) for name, histogram in self.histograms.items()),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def dump(self, filepath):
+        with open(filepath, 'w') as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=4, sort_keys=True)
+
+    def dump_forever(self, filepath, interval=5.0):
+        def dumploop():
+            while True:
+                time.sleep(interval)
+                self.dump(filepath)
+
+        t = threading.Thread(target=dumploop)
+        t.daemon = True
+        t.start()
+
+    def serve(self, host='127.0.0.1', port=9100):
+        # a local endpoint answering every GET with the current snapshot as json
+        server = HTTPServer((host, port), MetricsRequestHandler)
+        server.metrics = self
+
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+
+        return server
+
+metrics = Metrics()
@@ -0,0 +1,350 @@
+import heapq
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# step costs are scaled integers, float costs make equally good paths compare unequal
+# and turn the tie breaking below into a flood fill of open areas
+STRAIGHT_COST = 10
+DIAGONAL_COST = 14
+
+# the eight directions, a diagonal step is only allowed when both tiles it cuts past are walkable
+DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+def octile_distance(x, y, goal_x, goal_y):
+    dx, dy = abs(x - goal_x), abs(y - goal_y)
+    return STRAIGHT_COST * max(dx, dy) + (DIAGONAL_COST - STRAIGHT_COST) * min(dx, dy)
+
+def build_path(parents, node):
+    path = [node]
+
+    while node in parents:
+        node = parents[node]
+        path.append(node)
+
+    path.reverse()
+    return path
+
+def get_neighbors(grid, x, y):
+    walkable = grid.is_walkable
+
+    for dx, dy in DIRECTIONS:
+        if not walkable(x + dx, y + dy):
+            continue
+
+        if dx and dy and not (walkable(x + dx, y) and walkable(x, y + dy)):
+            continue
+
+        yield x + dx, y + dy
+
+def find_path_astar(grid, start, goal):
+    # a plain A* over the tile grid, returns every tile on the path from start to goal
+    if not grid.is_walkable(*goal):
+        return None
+
+    goal_x, goal_y = goal
+    costs = {start: 0}
+    parents = {}
+    closed = set()
+
+    # ties go to the node closest to the goal, which keeps open areas from being flooded,
+    # the counter breaks the remaining ties without comparing nodes
+    distance = octile_distance(start[0], start[1], goal_x, goal_y)
+    heap = [(distance, distance, 0, start)]
+    counter = 1
+
+    while heap:
+        node = heapq.heappop(heap)[-1]
+
+        if node == goal:
+            return build_path(parents, node)
+
+        if node in closed:
+            continue
+
+        closed.add(node)
+        x, y = node
+
+        for neighbor in get_neighbors(grid, x, y):
+            if neighbor in closed:
+                continue
+
+            neighbor_cost = costs[node] + (DIAGONAL_COST if neighbor[0] != x and neighbor[1] != y else STRAIGHT_COST)
+
+            if neighbor_cost >= costs.get(neighbor, float('inf')):
+                continue
+
+            costs[neighbor] = neighbor_cost
+            parents[neighbor] = node
+
+            distance = octile_distance(neighbor[0], neighbor[1], goal_x, goal_y)
+            heapq.heappush(heap, (neighbor_cost + distance, distance, counter, neighbor))
+            counter += 1
+
+    return None
+
+def get_padded_cells(grid):
+    # the grid's cells with a blocked border around them, so a search can
+    # step off any tile by adding an index offset without bounds checks
+    width = grid.width + 2
+    cells = bytearray(width * (grid.height + 2))
+
+    for y in range(grid.height):
+        start = (y + 1) * width + 1
+        cells[start:start + grid.width] = grid.cells[y * grid.width:(y + 1) * grid.width]
+
+    return cells
+
+class JumpPointSearch(object):
+
+    def __init__(self, grid, goal, cells=None):
+        self.cells = cells if cells is not None else get_padded_cells(grid)
+        self.width = grid.width + 2
+        self.goal = self.get_index(*goal)
+
+    def get_index(self, x, y):
+        return (y + 1) * self.width + x + 1
+
+    def get_tile(self, index):
+        return index % self.width - 1, index // self.width - 1
+
+    def jump(self, index, dx, dy):
+        # follow a direction until something forces a turn, straight jumps never recurse
+        # and diagonal jumps only recurse into straight ones, so deep maps can't blow the stack
+        cells = self.cells
+        goal = self.goal
+        row = self.width
+        step = dx + dy * row
+
+        while True:
+            if not cells[index]:
+                return None
+
+            if index == goal:
+                return index
+
+            if dx and dy:
+                if self.jump(index + dx, dx, 0) is not None or self.jump(index + dy * row, 0, dy) is not None:
+                    return index
+
+                if not (cells[index + dx] and cells[index + dy * row]):
+                    return None
+
+            elif dx:
+                # a wall above or below that just ended forces a turn
+                if (cells[index - row] and not cells[index - row - dx]) or (cells[index + row] and not cells[index + row - dx]):
+                    return index
+
+            elif (cells[index - 1] and not cells[index - 1 - step]) or (cells[index + 1] and not cells[index + 1 - step]):
+                return index
+
+            index += step
+
+    def get_directions(self, index, parent):
+        cells = self.cells
+        row = self.width
+        directions = []
+
+        if parent is None:
+            for dx, dy in DIRECTIONS:
+                if not cells[index + dx + dy * row]:
+                    continue
+
+                if dx and dy and not (cells[index + dx] and cells[index + dy * row]):
+                    continue
+
+                directions.append((dx, dy))
+
+            return directions
+
+        x, y = self.get_tile(index)
+        parent_x, parent_y = self.get_tile(parent)
+
+        dx = (x > parent_x) - (x < parent_x)
+        dy = (y > parent_y) - (y < parent_y)
+
+        # only the natural neighbors in the direction of travel and the ones a wall forces us to look at
+        if dx and dy:
+            vertical, horizontal = cells[index + dy * row], cells[index + dx]
+
+            if vertical:
+                directions.append((0, dy))
+
+            if horizontal:
+                directions.append((dx, 0))
+
+            if vertical and horizontal:
+                directions.append((dx, dy))
+
+        elif dx:
+            below, above = cells[index + row], cells[index - row]
+
+            if cells[index + dx]:
+                directions.append((dx, 0))
+
+                if below:
+                    directions.append((dx, 1))
+
+                if above:
+                    directions.append((dx, -1))
+
+            if below:
+                directions.append((0, 1))
+
+            if above:
+                directions.append((0, -1))
+
+        else:
+            right, left = cells[index + 1], cells[index - 1]
+
+            if cells[index + dy * row]:
+                directions.append((0, dy))
+
+                if right:
+                    directions.append((1, dy))
+
+                if left:
+                    directions.append((-1, dy))
+
+            if right:
+                directions.append((1, 0))
+
+            if left:
+                directions.append((-1, 0))
+
+        return directions
+
+    def find_path(self, start):
+        goal_x, goal_y = self.get_tile(self.goal)
+        start = self.get_index(*start)
+
+        costs = {start: 0}
+        parents = {}
+        closed = set()
+
+        x, y = self.get_tile(start)
+        distance = octile_distance(x, y, goal_x, goal_y)
+        heap = [(distance, distance, 0, start)]
+        counter = 1
+
+        while heap:
+            index = heapq.heappop(heap)[-1]
+
+            if index == self.goal:
+                return [self.get_tile(node) for node in build_path(parents, index)]
+
+            if index in closed:
+                continue
+
+            closed.add(index)
+            x, y = self.get_tile(index)
+
+            for dx, dy in self.get_directions(index, parents.get(index)):
+                jump_point = self.jump(index + dx + dy * self.width, dx, dy)
+
+                if jump_point is None or jump_point in closed:
+                    continue
+
+                jump_x, jump_y = self.get_tile(jump_point)
+                jump_cost = costs[index] + octile_distance(x, y, jump_x, jump_y)
+
+                if jump_cost >= costs.get(jump_point, float('inf')):
+                    continue
+
+                costs[jump_point] = jump_cost
+                parents[jump_point] = index
+
+                distance = octile_distance(jump_x, jump_y, goal_x, goal_y)
+                heapq.heappush(heap, (jump_cost + distance, distance, counter, jump_point))
+                counter += 1
+
+        return None
+
+def find_path_jps(grid, start, goal, cells=None):
+    # jump point search only expands the tiles where the path can turn, which
+    # skips over open areas, returns the turning points from start to goal
+    if not grid.is_walkable(*goal):
+        return None
+
+    return JumpPointSearch(grid, goal, cells).find_path(start)
+
+class PathRequest(object):
+
+    def __init__(self, start, goal):
+        self.start = start
+        self.goal = goal
+        self.path = None
+        self.done = False
+
+class PathfindingService(object):
+
+    def __init__(self, grid, jump_points=True, cache_size=256):
+        self.grid = grid
+        self.jump_points = jump_points
+        self.cells = get_padded_cells(grid) if jump_points else None
+
+        # paths are kept by their start and goal tile, the grid never changes during a game
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+
+        # searches run on a worker thread, so a long search never holds up a frame
+        self.requests = queue.Queue()
+
+        t = threading.Thread(target=self.worker)
+        t.daemon = True
+        t.start()
+
+    def get_cached(self, start, goal):
+        with self.cache_lock:
+            path = self.cache.get((start, goal))
+
+            if path is not None:
+                # move it to the end, the least recently used path is the first to go
+                del self.cache[(start, goal)]
+                self.cache[(start, goal)] = path
+
+            return path
+
+    def find(self, start, goal):
+        path = self.get_cached(start, goal)
+
+        if path is not None:
+            return path
+
+        # an unreachable goal is cached as an empty path
+        if self.jump_points:
+            path = find_path_jps(self.grid, start, goal, self.cells) or []
+        else:
+            path = find_path_astar(self.grid, start, goal) or []
+
+        with self.cache_lock:
+            self.cache[(start, goal)] = path
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return path
+
+    def request(self, start, goal):
+        request = PathRequest(start, goal)
+
+        # a cached path doesn't have to wait for the worker
+        request.path = self.get_cached(start, goal)
+        request.done = request.path is not None
+
+        if not request.done:
+            self.requests.put(request)
+
+        return request
+
+    def worker(self):
+        while True:
+            request = self.requests.get()
+
+            request.path = self.find(request.start, request.goal)
+            request.done = True
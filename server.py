@@ -1,134 +1,1063 @@
+import time
+import errno
 import socket
+import argparse
+import itertools
 import threading
+import collections
 
 try:
     import socketserver
 except ImportError:
     import SocketServer as socketserver
 
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
 import util
 import random
+import collision
+
+from array import array
+from metrics import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Player(object):
+    # a handle to a player's slot in the entity store, the player's state lives in the store's columns
+    __slots__ = ('store', 'slot', 'id')
 
-    def __init__(self, id, owner, x, y):
+    def __init__(self, store, slot, id):
+        self.store = store
+        self.slot = slot
         self.id = id
-        self.owner = owner
-        self.x = x
-        self.y = y
 
-class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
-    player_id = None
+    @property
+    def owner(self):
+        return bool(self.store.owners[self.slot])
 
-    def handle_send(self, data):
-        try:
-            self.request.sendall(data)
-        except socket.error:
+    @owner.setter
+    def owner(self, owner):
+        self.store.owners[self.slot] = owner
+
+    @property
+    def x(self):
+        return int(self.store.x[self.slot])
+
+    @property
+    def y(self):
+        return int(self.store.y[self.slot])
+
+    # set when the position changed since the last server tick
+    @property
+    def dirty(self):
+        return bool(self.store.dirty[self.slot])
+
+    def detach(self):
+        # the slot goes to the next player that is added, so a handle that is
+        # still held keeps the last state in a store of its own instead
+        store = EntityStore(capacity=1)
+        store.add(self.id, self.owner, self.x, self.y)
+
+        self.store = store
+        self.slot = 0
+
+class IdAllocator(object):
+
+    def __init__(self, index_bits=util.PLAYER_ID_INDEX_BITS, generation_bits=util.PLAYER_ID_GENERATION_BITS):
+        self.index_bits = index_bits
+        self.index_mask = (1 << index_bits) - 1
+        self.generation_mask = (1 << generation_bits) - 1
+
+        self.lock = threading.Lock()
+        self.generations = [0] * (self.index_mask + 1)
+
+        # every index is handed out once before a freed one is reused, and freed ones
+        # are reused oldest first, so an id goes as long as possible before it comes
+        # back, index 0 is never used so no id is ever 0
+        self.free_indexes = collections.deque()
+        self.next_index = 1
+
+    def allocate(self):
+        with self.lock:
+            if self.next_index <= self.index_mask:
+                index = self.next_index
+                self.next_index += 1
+            elif self.free_indexes:
+                index = self.free_indexes.popleft()
+            else:
+                return None
+
+            return self.generations[index] << self.index_bits | index
+
+    def release(self, entity_id):
+        index = entity_id & self.index_mask
+
+        with self.lock:
+            # a stale id of an earlier generation doesn't free the slot again
+            if not self.is_current(entity_id):
+                return
+
+            self.generations[index] = (self.generations[index] + 1) & self.generation_mask
+            self.free_indexes.append(index)
+
+    def is_current(self, entity_id):
+        return self.generations[entity_id & self.index_mask] == entity_id >> self.index_bits
+
+class EntityStore(object):
+    # every column with its numpy dtype and array typecode
+    COLUMNS = (
+        ('ids', 'i4', 'i'),
+        ('owners', 'u1', 'B'),
+        ('alive', 'u1', 'B'),
+        ('dirty', 'u1', 'B'),
+        ('x', 'i4', 'i'),
+        ('y', 'i4', 'i'),
+    )
+
+    def __init__(self, capacity=64):
+        # players are added and removed from the handler threads of the threaded server
+        self.lock = threading.Lock()
+
+        self.capacity = 0
+        self.size = 0 # slots that were ever used, the columns are only scanned up to here
+        self.free_slots = []
+
+        self.slots = {}
+        self.handles = {}
+
+        for name, dtype, typecode in self.COLUMNS:
+            setattr(self, name, self.create_column(dtype, typecode, 0))
+
+        self.grow(capacity)
+
+    def create_column(self, dtype, typecode, capacity):
+        if numpy is not None:
+            return numpy.zeros(capacity, dtype=dtype)
+
+        # flags are kept in bytearrays, which can be cleared with a slice assignment
+        if typecode == 'B':
+            return bytearray(capacity)
+
+        return array(typecode, [0]) * capacity
+
+    def grow(self, capacity):
+        for name, dtype, typecode in self.COLUMNS:
+            column = getattr(self, name)
+
+            # the columns stay contiguous, growing copies them into a bigger buffer
+            if numpy is not None:
+                grown = numpy.zeros(capacity, dtype=dtype)
+                grown[:self.capacity] = column
+            else:
+                grown = column + self.create_column(dtype, typecode, capacity - self.capacity)
+
+            setattr(self, name, grown)
+
+        self.capacity = capacity
+        self.clean = bytearray(capacity)
+
+    def add(self, entity_id, owner, x, y):
+        with self.lock:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                if self.size == self.capacity:
+                    self.grow(self.capacity * 2)
+
+                slot = self.size
+                self.size += 1
+
+            self.ids[slot] = entity_id
+            self.owners[slot] = owner
+            self.alive[slot] = 1
+            self.dirty[slot] = 0
+            self.x[slot] = int(x)
+            self.y[slot] = int(y)
+
+            handle = Player(self, slot, entity_id)
+            self.slots[entity_id] = slot
+            self.handles[entity_id] = handle
+
+            return handle
+
+    def remove(self, entity_id):
+        with self.lock:
+            slot = self.slots.pop(entity_id)
+            self.handles.pop(entity_id).detach()
+
+            self.alive[slot] = 0
+            self.dirty[slot] = 0
+            self.free_slots.append(slot)
+
+    def set_position(self, entity_id, x, y):
+        # only the selector thread touches the store of the selector servers,
+        # so a position update is just three stores into the columns
+        slot = self.slots[entity_id]
+        self.x[slot] = x
+        self.y[slot] = y
+        self.dirty[slot] = 1
+
+    def mark_dirty(self, entity_id):
+        self.dirty[self.slots[entity_id]] = 1
+
+    def collect_dirty(self):
+        # the id and position of every player that moved since the last call, clearing their dirty flags
+        with self.lock:
+            size = self.size
+
+            if numpy is not None:
+                slots = numpy.flatnonzero(self.dirty[:size] & self.alive[:size])
+                self.dirty[slots] = 0
+
+                return list(zip(self.ids[slots].tolist(), self.x[slots].tolist(), self.y[slots].tolist()))
+
+            # without numpy, compress still walks the dirty column in c and only hands
+            # back the slots that moved, a slice assignment clears the whole column
+            slots = list(itertools.compress(range(size), self.dirty))
+            self.dirty[:size] = self.clean[:size]
+
+            ids, x, y = self.ids, self.x, self.y
+            return [(ids[slot], x[slot], y[slot]) for slot in slots]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, entity_id):
+        return entity_id in self.slots
+
+    def __getitem__(self, entity_id):
+        return self.handles[entity_id]
+
+    def __delitem__(self, entity_id):
+        self.remove(entity_id)
+
+    def get(self, entity_id, default=None):
+        return self.handles.get(entity_id, default)
+
+    def keys(self):
+        return list(self.handles.keys())
+
+    def values(self):
+        return list(self.handles.values())
+
+class SynchronizedEntityStore(EntityStore):
+    # the threaded server moves players from every handler thread while the tick
+    # thread collects them, the lock keeps a move from being cleared unsent
+
+    def set_position(self, entity_id, x, y):
+        with self.lock:
+            EntityStore.set_position(self, entity_id, x, y)
+
+    def mark_dirty(self, entity_id):
+        with self.lock:
+            EntityStore.mark_dirty(self, entity_id)
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.time()
+
+    def consume(self, amount=1):
+        now = time.time()
+
+        # refill for the time that passed since the last consume, up to the bucket's capacity
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+# spatial hash cells span a whole number of map tiles. with the default interest radius of 2,
+# 16 tiles of 16px reach 512px from a player's cell along either axis, past the 400px from the
+# centre to the edge of the client's 800x600 screen, so players are spawned before they come into view
+SPATIAL_HASH_CELL_TILES = 16
+DEFAULT_TILE_SIZE = 16
+
+def get_cell_size(walkability=None):
+    tile_size = walkability.tile_width if walkability else DEFAULT_TILE_SIZE
+    return tile_size * SPATIAL_HASH_CELL_TILES
+
+class SpatialHash(object):
+
+    def __init__(self, cell_size=get_cell_size()):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entity_cells = {}
+
+    def get_cell(self, x, y):
+        return int(x) // self.cell_size, int(y) // self.cell_size
+
+    def update(self, entity_id, x, y):
+        cell = self.get_cell(x, y)
+        previous_cell = self.entity_cells.get(entity_id)
+
+        if cell == previous_cell:
             return
 
-    def setup(self):
+        if previous_cell is not None:
+            self.discard(entity_id, previous_cell)
+
+        self.cells.setdefault(cell, set()).add(entity_id)
+        self.entity_cells[entity_id] = cell
+
+    def discard(self, entity_id, cell):
+        entities = self.cells[cell]
+        entities.discard(entity_id)
+
+        # don't keep empty cells around, players roam over a lot of them
+        if not entities:
+            del self.cells[cell]
+
+    def remove(self, entity_id):
+        cell = self.entity_cells.pop(entity_id, None)
+
+        if cell is not None:
+            self.discard(entity_id, cell)
+
+    def query(self, x, y, radius):
+        cell_x, cell_y = self.get_cell(x, y)
+        entities = set()
+
+        for query_y in range(cell_y - radius, cell_y + radius + 1):
+            for query_x in range(cell_x - radius, cell_x + radius + 1):
+                entities.update(self.cells.get((query_x, query_y), ()))
+
+        return entities
+
+class PlayerHandlerMixIn:
+    player_id = None
+
+    def setup_player(self):
+        # the last position sent to this client for every player, snapshots
+        # only carry the players that moved away from it
+        self.snapshot_baseline = {}
+
+        # the players this client currently knows about
+        self.interest = set()
+
+        # positions can be sent over udp once the client proved it owns this token
+        self.udp_token = None
+        self.udp_address = None
+        self.udp_send_sequence = 0
+        self.udp_recv_sequence = 0
+
+        # position updates past the server's update rate are dropped
+        self.update_bucket = TokenBucket(self.server.max_update_rate, self.server.max_update_burst)
+
+        # the distance our player may still move, refilled at the server's max speed
+        self.movement_bucket = TokenBucket(self.server.max_speed, self.server.max_speed * self.server.max_movement_burst)
+
         self.server.add_handler(self)
 
+        # the client times its interpolation of remote players by our snapshots
+        self.handle_send(util.tick_rate_codec.encode(self.server.tick_rate))
+
+        if self.server.udp_socket:
+            self.udp_token = self.server.add_udp_handler(self)
+            self.handle_send(util.udp_token_codec.encode(self.udp_token))
+
+        # with interest management the tick spawns the players nearby once we have a player
+        if self.server.interest_managed:
+            return
+
         # send the initial creation for avatars that already exist
         for player in self.server.players.values():
             self.handle_send_player_spawn(player.id, player.x, player.y, False)
+            self.interest.add(player.id)
 
-    def handle(self):
-        while True:
-            try:
-                data = self.request.recv(1024)
-            except socket.error:
-                break
-
-            if not data:
-                break
+    def finish_player(self):
+        self.server.remove_handler(self)
+        self.server.remove_udp_handler(self)
 
-            data_buffer = util.DataBuffer(data)
+        if not self.player_id:
+            return
 
-            while len(data_buffer.remaining):
-                self.handle_packet(data_buffer.readByte(), data_buffer)
+        self.handle_send_player_despawn(self.player_id)
 
     def handle_packet(self, packet_id, data_buffer):
         if packet_id == util.PACKET_REQUEST_SPAWN:
-            self.player_id = self.server.new_player_id
+            # every connection controls a single player
+            if self.player_id:
+                return
 
-            # clear the buffer
-            data_buffer.clear()
+            player_id = self.server.allocate_player_id(self)
 
-            # get a random spawn position
-            x, y = random.choice(util.spawn_positions)
+            # every id is in use, the server is full
+            if player_id is None:
+                metrics.increment('server.rejected_spawns')
+                return
+
+            self.player_id = player_id
 
-            player = Player(self.player_id, True, x, y)
+            # get a random spawn position
+            x, y = random.choice(self.server.spawn_positions)
 
             # add the player to the server's list of players
-            self.server.players[self.player_id] = player
+            player = self.server.players.add(self.player_id, True, x, y)
+            self.server.players.mark_dirty(self.player_id)
 
             # send player spawn as owner to the owner's client
             self.handle_send_player_spawn(player.id, player.x, player.y, False, True)
+            self.interest.add(player.id)
+
+            if self.server.interest_managed:
+                return
 
             # now broadcast to everyone else as a regular player
             self.handle_send_player_spawn(player.id, player.x, player.y, True, False)
 
+            for handler in list(self.server.handlers):
+                handler.interest.add(player.id)
+
         elif packet_id == util.PACKET_POSITION_UPDATE:
             try:
-                player_id = data_buffer.readSByte()
-                x = data_buffer.readShort()
-                y = data_buffer.readShort()
-
-                # clear the buffer
-                data_buffer.clear()
+                player_id, x, y = util.position_update_codec.decode(data_buffer)
             except:
-                return self.request.close()
+                return self.close_request()
+
+            # a connection can only move the player it spawned
+            if player_id != self.player_id or player_id not in self.server.players:
+                metrics.increment('server.rejected_updates')
+                return
 
-            if player_id not in self.server.players:
+            if not self.update_bucket.consume():
+                metrics.increment('server.dropped_updates')
                 return
 
             player = self.server.players[player_id]
-            player.x = x
-            player.y = y
 
-            self.handle_send_player_position_update(player_id, x, y)
+            # the update moved the player further than it could have walked, keep it where it was
+            if not self.movement_bucket.consume(max(abs(x - player.x), abs(y - player.y))):
+                return self.handle_send_position_correction(player)
+
+            # or it walked through something on the map
+            walkability = self.server.walkability
+
+            if walkability and not walkability.is_move_valid(int(player.x), int(player.y), x, y):
+                return self.handle_send_position_correction(player)
+
+            self.server.players.set_position(player_id, x, y)
+
+            # without a tick loop, position updates are re-broadcast as they arrive
+            if not self.server.tick_rate:
+                self.handle_send_player_position_update(player_id, x, y)
+
+    def handle_send_position_correction(self, player):
+        metrics.increment('server.corrected_updates')
+
+        if self.server.tick_rate:
+            # without a baseline the next snapshot carries the player's absolute position
+            self.snapshot_baseline.pop(player.id, None)
+            self.server.players.mark_dirty(player.id)
+        else:
+            self.handle_send(util.position_update_codec.encode(player.id, player.x, player.y))
 
     def handle_send_player_spawn(self, player_id, x, y, broadcast=False, owner=False):
-        data_buffer = util.DataBuffer()
-        data_buffer.writeByte(util.PACKET_SPAWN)
-        data_buffer.writeSByte(player_id)
-        data_buffer.writeByte(owner)
-        data_buffer.writeShort(x)
-        data_buffer.writeShort(y)
+        data = util.spawn_codec.encode(player_id, owner, x, y)
 
         if broadcast:
-            self.server.broadcast_data(self, data_buffer.data)
+            self.server.broadcast_data(self, data)
         else:
-            self.handle_send(data_buffer.data)
+            self.handle_send(data)
 
     def handle_send_player_despawn(self, player_id):
-        data_buffer = util.DataBuffer()
-        data_buffer.writeByte(util.PACKET_DESPAWN)
-        data_buffer.writeSByte(player_id)
+        data = util.despawn_codec.encode(player_id)
+
+        # send to everyone that knows about the player, except us.
+        for handler in list(self.server.handlers):
+            if handler == self or player_id not in handler.interest:
+                continue
 
-        # send to everyone except us.
-        self.server.broadcast_data(self, data_buffer.data)
+            handler.despawn_interest(player_id, data)
 
         # remove the player from the server's list of players
-        del self.server.players[player_id]
+        self.server.remove_player(player_id)
+
+    def despawn_interest(self, player_id, data=None):
+        self.interest.discard(player_id)
+
+        # the client drops its baseline with the player, so must we
+        self.snapshot_baseline.pop(player_id, None)
+
+        self.handle_send(data or util.despawn_codec.encode(player_id))
+
+    def update_interest(self):
+        player = self.server.players.get(self.player_id)
+
+        if player is None:
+            return
+
+        visible = self.server.spatial_hash.query(player.x, player.y, self.server.interest_radius)
+
+        # players that came into our area, they are spawned with their current position
+        for player_id in visible - self.interest:
+            other = self.server.players.get(player_id)
+
+            if other is None:
+                continue
+
+            self.handle_send_player_spawn(other.id, other.x, other.y)
+            self.snapshot_baseline[player_id] = (int(other.x), int(other.y))
+            self.interest.add(player_id)
+
+        # players that left our area, or that we left
+        for player_id in self.interest - visible:
+            if player_id == self.player_id:
+                continue
+
+            self.despawn_interest(player_id)
 
     def handle_send_player_position_update(self, player_id, x, y):
-        data_buffer = util.DataBuffer()
-        data_buffer.writeByte(util.PACKET_POSITION_UPDATE)
-        data_buffer.writeSByte(player_id)
-        data_buffer.writeShort(x)
-        data_buffer.writeShort(y)
+        self.server.broadcast_data(self, util.position_update_codec.encode(player_id, x, y))
+
+class ThreadedTCPRequestHandler(PlayerHandlerMixIn, socketserver.BaseRequestHandler):
+
+    def handle_send(self, data):
+        # broadcasts are sent from other handlers' threads and the tick thread,
+        # the lock stops their frames from interleaving on the socket
+        frame = util.pack_frame(data)
+
+        with self.send_lock:
+            try:
+                self.request.sendall(frame)
+            except socket.error:
+                return
+
+        metrics.increment('net.packets_out')
+        metrics.increment('net.bytes_out', len(frame))
+
+    def close_request(self):
+        self.request.close()
+
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.setup_player()
+
+    def handle(self):
+        decoder = util.PacketDecoder()
+
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except socket.error:
+                break
+
+            if not data:
+                break
 
-        self.server.broadcast_data(self, data_buffer.data)
+            metrics.increment('net.bytes_in', len(data))
+
+            for data_buffer in decoder.feed(data):
+                metrics.increment('net.packets_in')
+                self.handle_packet(data_buffer.readByte(), data_buffer)
 
     def finish(self):
-        self.server.remove_handler(self)
+        self.finish_player()
 
-        if not self.player_id:
+class SelectorRequestHandler(PlayerHandlerMixIn, object):
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.closed = False
+
+        self.decoder = util.PacketDecoder()
+
+        # frames waiting for the socket to become writable again
+        self.write_queue = collections.deque()
+        self.write_queue_size = 0
+
+    def handle_send(self, data):
+        if self.closed:
             return
 
-        self.handle_send_player_despawn(self.player_id)
+        frame = util.pack_frame(data)
+
+        # a client that stopped reading would make its queue grow forever,
+        # drop it instead of letting it hold on to the server's memory
+        if self.write_queue_size + len(frame) > self.server.max_write_queue_size:
+            return self.close_request()
+
+        was_empty = not self.write_queue
+
+        metrics.increment('net.packets_out')
+
+        self.write_queue.append(frame)
+        self.write_queue_size += len(frame)
+
+        # try to send straight away, only wait for the selector when the socket is full
+        if was_empty:
+            self.handle_write()
+
+    def handle_read(self):
+        try:
+            data = self.request.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            return self.close_request()
+
+        if not data:
+            return self.close_request()
+
+        self.handle_data(data)
+
+    def handle_data(self, data):
+        metrics.increment('net.bytes_in', len(data))
+
+        for data_buffer in self.decoder.feed(data):
+            metrics.increment('net.packets_in')
+            self.handle_packet(data_buffer.readByte(), data_buffer)
+
+            if self.closed:
+                break
+
+    def handle_write(self):
+        while self.write_queue:
+            # coalesce everything that is queued into a single send call
+            if len(self.write_queue) > 1:
+                data = b''.join(self.write_queue)
+                self.write_queue.clear()
+                self.write_queue.append(data)
+
+            data = self.write_queue[0]
+
+            try:
+                sent = self.request.send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                return self.close_request()
+
+            self.write_queue_size -= sent
+            metrics.increment('net.bytes_out', sent)
+
+            if sent < len(data):
+                self.write_queue[0] = data[sent:]
+                break
+
+            self.write_queue.popleft()
+
+        self.server.update_events(self)
+
+    def close_request(self):
+        self.server.close_request(self)
+
+class PlayerServerMixIn:
+    tick_rate = 20 # snapshots sent per second, 0 to re-broadcast every update
+    interest_radius = 2 # spatial hash cells around a player it receives updates for, 0 for everything
+    udp_refresh_ticks = 20 # ticks between resending every known position to udp clients
+
+    max_update_rate = 30 # position updates accepted from a client per second
+    max_update_burst = 10 # position updates a client may send at once after a quiet period
+    max_speed = 90 # pixels per second a player may move along either axis
+    max_movement_burst = 0.5 # seconds worth of movement that may arrive at once, for network jitter
+
+    walkability = None # the map's walkability grid moves are validated against, None to accept any move
+    spawn_positions = util.spawn_positions
+
+    def setup_walkability(self, map_filepath):
+        self.walkability = collision.load_walkability(map_filepath)
+
+        if self.walkability is None:
+            return
+
+        # don't spawn players on top of something they can't walk out of
+        self.spawn_positions = [position for position in util.spawn_positions
+            if self.walkability.is_area_walkable(*position)] or util.spawn_positions
+
+    def allocate_player_id(self, handler):
+        return self.player_ids.allocate()
+
+    def remove_player(self, player_id):
+        del self.players[player_id]
+        self.spatial_hash.remove(player_id)
+        self.player_ids.release(player_id)
+
+    udp_socket = None
+    udp_emulator = None
+    tick_count = 0
+
+    def add_handler(self, handler):
+        if handler in self.handlers:
+            return
+
+        self.handlers.append(handler)
+
+    def remove_handler(self, handler):
+        if handler not in self.handlers:
+            return
+
+        self.handlers.remove(handler)
+
+    def broadcast_data(self, sender_handler, data):
+        # iterate over a copy, a slow handler may be dropped while we're sending
+        for handler in list(self.handlers):
+            if handler == sender_handler:
+                continue
+
+            handler.handle_send(data)
+
+    def setup_udp(self, server_address, emulator=None):
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind(server_address)
+        self.udp_emulator = emulator
+
+    def add_udp_handler(self, handler):
+        token = self.udp_random.getrandbits(32)
+
+        while token in self.udp_handlers:
+            token = self.udp_random.getrandbits(32)
+
+        self.udp_handlers[token] = handler
+        return token
+
+    def remove_udp_handler(self, handler):
+        if handler.udp_token is not None:
+            self.udp_handlers.pop(handler.udp_token, None)
+
+    def handle_datagram(self, data, address):
+        metrics.increment('net.datagrams_in')
+        metrics.increment('net.bytes_in', len(data))
+
+        try:
+            token, sequence, data_buffer = util.unpack_datagram(data)
+        except:
+            return
+
+        handler = self.udp_handlers.get(token)
+
+        # unknown connections, stale and duplicated datagrams are dropped
+        if handler is None or sequence <= handler.udp_recv_sequence:
+            return
+
+        handler.udp_recv_sequence = sequence
+        handler.udp_address = address
+
+        # an empty datagram only tells us the client's udp address
+        if not len(data_buffer.remaining):
+            return
+
+        packet_id = data_buffer.readByte()
+
+        # only unreliable traffic is accepted over udp
+        if packet_id != util.PACKET_POSITION_UPDATE:
+            return
+
+        handler.handle_packet(packet_id, data_buffer)
+
+    def send_datagram(self, handler, data):
+        handler.udp_send_sequence += 1
+        datagram = util.pack_datagram(handler.udp_token, handler.udp_send_sequence, data)
+
+        metrics.increment('net.datagrams_out')
+        metrics.increment('net.bytes_out', len(datagram))
+
+        try:
+            if self.udp_emulator:
+                self.udp_emulator.schedule(self.udp_socket.sendto, datagram, handler.udp_address)
+            else:
+                self.udp_socket.sendto(datagram, handler.udp_address)
+        except socket.error:
+            return
+
+    def udp_forever(self):
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(65536)
+            except socket.error:
+                continue
+
+            self.handle_datagram(data, address)
+
+    @property
+    def tick_interval(self):
+        return 1.0 / self.tick_rate
+
+    @property
+    def interest_managed(self):
+        return bool(self.tick_rate and self.interest_radius)
+
+    def tick(self):
+        with metrics.timer('server.tick_ms'):
+            self.send_snapshots()
+
+        handlers = list(self.handlers)
+        write_queue_sizes = [getattr(handler, 'write_queue_size', 0) for handler in handlers]
+
+        metrics.set_gauge('server.players', len(self.players))
+        metrics.set_gauge('server.connections', len(handlers))
+        metrics.set_gauge('net.write_queue_bytes', sum(write_queue_sizes))
+        metrics.set_gauge('net.write_queue_max_bytes', max(write_queue_sizes or [0]))
+
+    def send_snapshots(self):
+        self.tick_count += 1
+
+        # udp snapshots can get lost, so every now and then udp clients get every position again
+        refresh = self.udp_socket is not None and not self.tick_count % self.udp_refresh_ticks
+
+        dirty_players = self.collect_dirty_players()
+
+        if not dirty_players and not refresh:
+            return
+
+        # spawn and despawn players that entered or left each client's area of interest
+        if dirty_players and self.interest_managed:
+            for handler in list(self.handlers):
+                handler.update_interest()
+
+        # most clients share the same baseline for a player, so each distinct
+        # entry is only encoded once per tick
+        entry_cache = {}
+
+        # every client gets its own delta snapshot, including its own player's position
+        for handler in list(self.handlers):
+            if handler.udp_address:
+                self.send_datagram_snapshot(handler, dirty_players, entry_cache, refresh)
+                continue
+
+            baseline = handler.snapshot_baseline
+            entries = []
+
+            # only look at the players the client knows about, which keeps
+            # the fan out proportional to the players nearby
+            if self.interest_managed and len(handler.interest) < len(dirty_players):
+                player_ids = handler.interest
+            else:
+                player_ids = dirty_players
+
+            for player_id in list(player_ids):
+                position = dirty_players.get(player_id)
+
+                if position is None or player_id not in handler.interest:
+                    continue
+
+                previous_position = baseline.get(player_id)
+
+                if previous_position == position:
+                    continue
+
+                key = (player_id, previous_position)
+                entry = entry_cache.get(key)
+
+                if entry is None:
+                    entry = entry_cache[key] = util.encode_delta_entry(player_id, position[0], position[1], previous_position)
+
+                entries.append(entry)
+                baseline[player_id] = position
+
+            for data in util.encode_delta_snapshots(entries):
+                handler.handle_send(data)
+
+    def collect_dirty_players(self):
+        dirty_players = {}
+
+        # a single scan over the store's dirty column instead of a visit to every player
+        for player_id, x, y in self.players.collect_dirty():
+            dirty_players[player_id] = (x, y)
+            self.spatial_hash.update(player_id, x, y)
+
+        return dirty_players
+
+    def send_datagram_snapshot(self, handler, dirty_players, entry_cache, refresh=False):
+        entries = []
+
+        for player_id in list(handler.interest if refresh else dirty_players):
+            if player_id not in handler.interest:
+                continue
+
+            position = dirty_players.get(player_id)
+
+            if position is None:
+                player = self.players.get(player_id)
+
+                if not refresh or player is None:
+                    continue
+
+                position = (int(player.x), int(player.y))
+
+            # a datagram may be lost, so it can't rely on an earlier one as
+            # its baseline, udp snapshots only carry absolute positions
+            key = (player_id, None, position)
+            entry = entry_cache.get(key)
+
+            if entry is None:
+                entry = entry_cache[key] = util.encode_delta_entry(player_id, position[0], position[1])
+
+            entries.append(entry)
+
+        for data in util.encode_delta_snapshots(entries, util.MAX_DATAGRAM_SNAPSHOT_ENTRIES):
+            self.send_datagram(handler, data)
+
+    def tick_forever(self):
+        next_tick = time.time()
+
+        while True:
+            next_tick += self.tick_interval
+            self.tick()
+
+            delay = next_tick - time.time()
+
+            # we fell more than a tick behind, don't try to catch up with a burst of ticks
+            if delay < -self.tick_interval:
+                next_tick = time.time()
+            elif delay > 0:
+                time.sleep(delay)
+
+class SelectorServer(PlayerServerMixIn, object):
+    request_queue_size = 1024 # maximum pending tcp connections
+    max_write_queue_size = 256 * 1024 # bytes queued for a client before it is dropped
+
+    handlers = []
+    players = EntityStore()
+    player_ids = IdAllocator()
+    spatial_hash = SpatialHash()
+
+    udp_handlers = {}
+    udp_random = random.SystemRandom()
+
+    def __init__(self, server_address, RequestHandlerClass=SelectorRequestHandler):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+
+        # closed connections whose players still have to be despawned
+        self.closed_handlers = collections.deque()
+        self.finishing = False
+
+    def setup_udp(self, server_address, emulator=None):
+        PlayerServerMixIn.setup_udp(self, server_address, emulator)
+
+        self.udp_socket.setblocking(False)
+        self.selector.register(self.udp_socket, selectors.EVENT_READ, self)
+
+    def handle_datagrams(self):
+        # read everything that is pending, not just one datagram per wakeup
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+
+                continue
+
+            self.handle_datagram(data, address)
+
+    def serve_forever(self, poll_interval=0.5):
+        next_tick = time.time()
+
+        while True:
+            timeout = poll_interval
+
+            # wake up in time for the next tick, snapshots are sent from this thread too
+            if self.tick_rate:
+                now = time.time()
+
+                if now >= next_tick:
+                    self.tick()
+                    next_tick = max(next_tick + self.tick_interval, now)
+
+                timeout = min(poll_interval, max(0, next_tick - now))
+
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self.handle_accept()
+                    continue
+
+                if key.data is self:
+                    self.handle_datagrams()
+                    continue
+
+                handler = key.data
+
+                if mask & selectors.EVENT_READ:
+                    handler.handle_read()
+
+                if mask & selectors.EVENT_WRITE and not handler.closed:
+                    handler.handle_write()
+
+    def handle_accept(self):
+        # accept everything that is pending, not just one connection per wakeup
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+
+                raise
+
+            request.setblocking(False)
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            handler = self.RequestHandlerClass(request, client_address, self)
+            self.selector.register(request, selectors.EVENT_READ, handler)
+
+            handler.setup_player()
+
+    def update_events(self, handler):
+        if handler.closed:
+            return
+
+        events = selectors.EVENT_READ
+
+        if handler.write_queue:
+            events |= selectors.EVENT_WRITE
+
+        if self.selector.get_key(handler.request).events != events:
+            self.selector.modify(handler.request, events, handler)
+
+    def close_request(self, handler):
+        if handler.closed:
+            return
+
+        handler.closed = True
+
+        self.selector.unregister(handler.request)
+        handler.request.close()
+
+        # despawning a player sends to every other client, which can close them in turn,
+        # finish them one after another instead of recursing through every connection
+        self.closed_handlers.append(handler)
+
+        if self.finishing:
+            return
+
+        self.finishing = True
+
+        try:
+            while self.closed_handlers:
+                self.closed_handlers.popleft().finish_player()
+        finally:
+            self.finishing = False
+
+    def server_close(self):
+        self.selector.close()
+        self.socket.close()
 
 class ThreadingMixIn:
     daemon_threads = True
@@ -148,38 +1077,116 @@ class ThreadingMixIn:
         t.setDaemon(self.daemon_threads)
         t.start()
 
-class ThreadedTCPServer(ThreadingMixIn, socketserver.TCPServer):
+class ThreadedTCPServer(PlayerServerMixIn, ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True # allows address reuse
     request_queue_size = 100 # maximum allowed tcp connections at once
 
     handlers = []
-    players = {}
+    players = SynchronizedEntityStore()
+    player_ids = IdAllocator()
+    spatial_hash = SpatialHash()
 
-    def add_handler(self, handler):
-        if handler in self.handlers:
-            return
+    udp_handlers = {}
+    udp_random = random.SystemRandom()
 
-        self.handlers.append(handler)
+    def serve_forever(self, poll_interval=0.5):
+        if self.tick_rate:
+            t = threading.Thread(target=self.tick_forever)
+            t.daemon = True
+            t.start()
 
-    def remove_handler(self, handler):
-        if handler not in self.handlers:
-            return
+        if self.udp_socket:
+            t = threading.Thread(target=self.udp_forever)
+            t.daemon = True
+            t.start()
 
-        self.handlers.remove(handler)
+        socketserver.TCPServer.serve_forever(self, poll_interval)
 
-    def broadcast_data(self, sender_handler, data):
-        for handler in self.handlers:
-            if handler == sender_handler:
-                continue
+def create_argument_parser():
+    parser = argparse.ArgumentParser(description='Syndicate game server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=10000)
+    parser.add_argument('--selector', action='store_true',
+        help='serve every connection from a single thread with non-blocking sockets')
+    parser.add_argument('--shards', type=int, default=0,
+        help='split the map into regions served by this many worker processes behind a front-end')
+    parser.add_argument('--world-width', type=int,
+        help='width in pixels of the world split between the shards when no map is given, 1024 by default')
+    parser.add_argument('--world-height', type=int,
+        help='height in pixels of the world split between the shards when no map is given, 1024 by default')
+    parser.add_argument('--tick-rate', type=int, default=PlayerServerMixIn.tick_rate,
+        help='position snapshots sent per second, 0 to re-broadcast every update')
+    parser.add_argument('--interest-radius', type=int, default=PlayerServerMixIn.interest_radius,
+        help='cells around a player it receives updates for, 0 to receive everything')
+    parser.add_argument('--cell-size', type=int,
+        help='spatial hash cell size in pixels, a multiple of the map tile size, 16 tiles by default')
+    parser.add_argument('--udp', action='store_true',
+        help='also accept position updates and send snapshots over udp on the same port')
+    parser.add_argument('--udp-loss', type=float, default=0.0,
+        help='emulated loss rate of sent udp datagrams, between 0 and 1')
+    parser.add_argument('--udp-latency', type=float, default=0.0,
+        help='emulated latency of sent udp datagrams in seconds')
+    parser.add_argument('--udp-jitter', type=float, default=0.0,
+        help='emulated latency jitter of sent udp datagrams in seconds')
+    parser.add_argument('--max-update-rate', type=int, default=PlayerServerMixIn.max_update_rate,
+        help='position updates accepted from a client per second, the rest are dropped')
+    parser.add_argument('--max-speed', type=int, default=PlayerServerMixIn.max_speed,
+        help='pixels per second a player may move, faster updates are corrected')
+    parser.add_argument('--map', default='assets/Maps/test.tmx',
+        help='the map player moves are validated against, an empty path accepts any move')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='dump the server metrics to FILE as json every few seconds')
+    parser.add_argument('--metrics-port', type=int,
+        help='serve the server metrics as json over http on localhost')
 
-            handler.handle_send(data)
+    return parser
 
-    @property
-    def new_player_id(self):
-        return len(self.players) + 1
+def configure_server(server, args):
+    server.tick_rate = args.tick_rate
+    server.interest_radius = args.interest_radius
+    server.max_update_rate = args.max_update_rate
+    server.max_speed = args.max_speed
 
-if __name__ == '__main__':
-    HOST, PORT = '0.0.0.0', 10000
+    if args.map:
+        server.setup_walkability(args.map)
+
+    server.spatial_hash = SpatialHash(args.cell_size or get_cell_size(server.walkability))
+
+def serve(args):
+    if args.selector:
+        server = SelectorServer((args.host, args.port))
+    else:
+        server = ThreadedTCPServer((args.host, args.port), ThreadedTCPRequestHandler)
+
+    configure_server(server, args)
+
+    if args.udp:
+        emulator = None
+
+        if args.udp_loss or args.udp_latency or args.udp_jitter:
+            emulator = util.NetworkEmulator(args.udp_loss, args.udp_latency, args.udp_jitter)
+
+        server.setup_udp((args.host, args.port), emulator)
+
+    if args.metrics:
+        metrics.dump_forever(args.metrics)
+
+    if args.metrics_port:
+        metrics.serve(port=args.metrics_port)
 
-    server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
     server.serve_forever(poll_interval=0.01)
+
+if __name__ == '__main__':
+    parser = create_argument_parser()
+    args = parser.parse_args()
+
+    if args.shards:
+        # every shard runs the selector server's loop, which needs a tick loop and interest
+        # management to tell which players are near a region border, udp isn't routed yet
+        if args.udp or not (args.tick_rate and args.interest_radius):
+            parser.error('--shards needs a tick rate and an interest radius, and no --udp')
+
+        import shard
+        shard.serve(args)
+    else:
+        serve(args)
@@ -0,0 +1,700 @@
+import os
+import errno
+import signal
+import socket
+import collections
+import multiprocessing
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+import util
+import server
+import collision
+
+from array import array
+from metrics import metrics
+
+# the size of the world in pixels when no map is given, the size of the test map
+DEFAULT_WORLD_WIDTH = 1024
+DEFAULT_WORLD_HEIGHT = 1024
+
+# half the width of the client's 800x600 screen, a client standing on a region border
+# can't see a player further across it than this, however far the interest radius reaches
+CLIENT_VIEW_DISTANCE = 400
+
+# pixels a player has to walk past a region border before it is handed off, so
+# a player standing on the border isn't passed back and forth with every step
+HANDOFF_HYSTERESIS = 32
+
+# messages between the front-end and its shards are framed with a 32 bit length,
+# a handed off connection carries everything that was still queued for its client
+link_frame_header = util.get_struct('I')
+
+# client sockets received in a single read, they are passed along one message at a time
+MAX_LINK_SOCKETS = 64
+
+LINK_CONNECTION = 0x00 # front-end to shard, a client socket the shard serves from now on
+LINK_HANDOFF = 0x01 # shard to front-end, a client socket whose player left the shard's region
+LINK_CLOSED = 0x02 # shard to front-end, a connection was closed and its player id is free again
+LINK_GHOSTS = 0x03 # both ways, players near a region border that another shard's clients can see
+
+# player id, spawned, x, y, followed by the bytes received from the client that
+# weren't handled yet and the bytes that weren't sent to it yet, with their lengths
+connection_codec = util.PacketCodec(LINK_CONNECTION, 'HBhhII')
+handoff_codec = util.PacketCodec(LINK_HANDOFF, 'HBhhII')
+
+# player id
+closed_codec = util.PacketCodec(LINK_CLOSED, 'H')
+
+# update count and removal count, followed by a player id, x, y entry
+# for every update and a player id for every removal
+ghosts_codec = util.PacketCodec(LINK_GHOSTS, 'HH')
+ghost_entry_struct = util.get_struct('Hhh')
+ghost_removal_struct = util.get_struct('H')
+
+def encode_ghosts(updates, removals):
+    data_buffer = util.DataBuffer()
+    ghosts_codec.write(data_buffer, len(updates), len(removals))
+
+    for player_id, x, y in updates:
+        data_buffer.writeStruct(ghost_entry_struct, player_id, x, y)
+
+    for player_id in removals:
+        data_buffer.writeStruct(ghost_removal_struct, player_id)
+
+    return data_buffer.data
+
+def decode_ghosts(data_buffer):
+    update_count, removal_count = ghosts_codec.decode(data_buffer)
+
+    updates = [data_buffer.readStruct(ghost_entry_struct) for _ in range(update_count)]
+    removals = [data_buffer.readStruct(ghost_removal_struct)[0] for _ in range(removal_count)]
+
+    return updates, removals
+
+class ShardLayout(object):
+
+    def __init__(self, shards, world_width, world_height, margin, hysteresis=HANDOFF_HYSTERESIS):
+        self.shards = shards
+        self.margin = margin
+        self.hysteresis = hysteresis
+
+        # the map is cut into a grid of regions of equal size, one per shard, with the
+        # columns and rows picked so the regions come out as square as they can be.
+        # the regions along the edges reach past the map's edges
+        self.columns = min([columns for columns in range(1, shards + 1) if not shards % columns],
+            key=lambda columns: abs(float(world_width) / columns - float(world_height) / (shards // columns)))
+        self.rows = shards // self.columns
+
+        self.region_width = max(1, world_width // self.columns)
+        self.region_height = max(1, world_height // self.rows)
+
+    def get_column(self, x):
+        return min(self.columns - 1, max(0, int(x) // self.region_width))
+
+    def get_row(self, y):
+        return min(self.rows - 1, max(0, int(y) // self.region_height))
+
+    def get_shard(self, x, y):
+        return self.get_row(y) * self.columns + self.get_column(x)
+
+    def get_region(self, index):
+        column, row = index % self.columns, index // self.columns
+        return (column * self.region_width, row * self.region_height,
+            (column + 1) * self.region_width, (row + 1) * self.region_height)
+
+    def has_left(self, index, x, y):
+        # a player walking back and forth over a border stays with its shard within the hysteresis
+        column, row = index % self.columns, index // self.columns
+        hysteresis = self.hysteresis
+
+        return not (self.get_column(x - hysteresis) <= column <= self.get_column(x + hysteresis) and
+            self.get_row(y - hysteresis) <= row <= self.get_row(y + hysteresis))
+
+    def get_ghost_shards(self, x, y):
+        # every shard with a client that may see a player standing at x, y, a region
+        # narrower than the margin ghosts a player into the shards past it as well
+        margin = self.margin
+
+        return [row * self.columns + column
+            for row in range(self.get_row(y - margin), self.get_row(y + margin) + 1)
+            for column in range(self.get_column(x - margin), self.get_column(x + margin) + 1)]
+
+    def is_near_border(self, index, x, y):
+        return any(other != index for other in self.get_ghost_shards(x, y))
+
+class ShardLink(object):
+
+    def __init__(self, request, owner, index=0):
+        self.request = request
+        self.request.setblocking(False)
+
+        self.owner = owner
+        self.index = index
+        self.closed = False
+        self.selector = None
+
+        self.decoder = util.PacketDecoder(link_frame_header)
+
+        # client sockets that arrived with the messages that weren't handled yet
+        self.received_sockets = collections.deque()
+
+        # frames waiting for the link to become writable again, with the client socket they pass along
+        self.write_queue = collections.deque()
+
+    def register(self, selector):
+        self.selector = selector
+        self.selector.register(self.request, selectors.EVENT_READ, self)
+
+    def send(self, data, connection=None):
+        was_empty = not self.write_queue
+        self.write_queue.append([link_frame_header.pack(len(data)) + data, connection])
+
+        if was_empty:
+            self.handle_write()
+
+    def handle_write(self):
+        while self.write_queue:
+            # coalesce the frames queued up to the next one passing a socket into a single send call
+            if len(self.write_queue) > 1 and self.write_queue[0][1] is None:
+                frames = []
+
+                while self.write_queue and self.write_queue[0][1] is None:
+                    frames.append(self.write_queue.popleft()[0])
+
+                self.write_queue.appendleft([b''.join(frames), None])
+
+            data, connection = self.write_queue[0]
+
+            try:
+                if connection is None:
+                    sent = self.request.send(data)
+                else:
+                    sent = self.request.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array('i', [connection.fileno()]))])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                raise
+
+            # the kernel keeps a socket in flight open, so our copy can be closed once it's sent
+            if connection is not None:
+                connection.close()
+                self.write_queue[0][1] = None
+
+            if sent < len(data):
+                self.write_queue[0][0] = data[sent:]
+                break
+
+            self.write_queue.popleft()
+
+        self.update_events()
+
+    def update_events(self):
+        if self.selector is None:
+            return
+
+        events = selectors.EVENT_READ
+
+        if self.write_queue:
+            events |= selectors.EVENT_WRITE
+
+        if self.selector.get_key(self.request).events != events:
+            self.selector.modify(self.request, events, self)
+
+    def handle_read(self):
+        try:
+            data, ancillary, flags, address = self.request.recvmsg(65536,
+                socket.CMSG_SPACE(MAX_LINK_SOCKETS * array('i').itemsize))
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            raise
+
+        if not data:
+            self.closed = True
+            return self.owner.handle_link_closed(self)
+
+        for level, message_type, message_data in ancillary:
+            if level != socket.SOL_SOCKET or message_type != socket.SCM_RIGHTS:
+                continue
+
+            fds = array('i')
+            fds.frombytes(message_data[:len(message_data) - len(message_data) % fds.itemsize])
+
+            self.received_sockets.extend(socket.socket(fileno=fd) for fd in fds)
+
+        for data_buffer in self.decoder.feed(data):
+            self.owner.handle_link_message(self, data_buffer.readByte(), data_buffer)
+
+class ShardServer(server.SelectorServer):
+    handlers = []
+    players = server.EntityStore()
+    spatial_hash = server.SpatialHash()
+
+    def __init__(self, index, link_request, layout, RequestHandlerClass=server.SelectorRequestHandler):
+        self.index = index
+        self.layout = layout
+        self.RequestHandlerClass = RequestHandlerClass
+
+        # clients connect to the front-end, which passes their sockets on to us
+        self.socket = None
+
+        self.selector = selectors.DefaultSelector()
+        self.link = ShardLink(link_request, self)
+        self.link.register(self.selector)
+
+        self.closed_handlers = collections.deque()
+        self.finishing = False
+
+        # the handler of every player this shard owns, the other players in the store are ghosts,
+        # players owned by a neighboring shard that are close enough to our clients to be seen
+        self.connections = {}
+
+        # players of ours the front-end was told about since they came near a border
+        self.published = set()
+
+        self.ghost_updates = []
+        self.ghost_removals = []
+
+    def setup_spawn_positions(self):
+        grid = self.walkability
+
+        # without a map the default spawn points are moved into our region, and kept
+        # inside it when the region is smaller than the spread of the spawn points
+        if grid is None:
+            start_x, start_y, end_x, end_y = self.layout.get_region(self.index)
+            self.spawn_positions = [[min(x + start_x, end_x - 1), min(y + start_y, end_y - 1)]
+                for x, y in util.spawn_positions]
+            return
+
+        # players spawn anywhere in the region instead of on the map's spawn points,
+        # so they are spread over the shards the front-end balanced them over
+        positions = []
+
+        for tile_y in range(grid.height):
+            for tile_x in range(grid.width):
+                position = grid.get_box_position(tile_x, tile_y)
+
+                if self.layout.get_shard(*position) == self.index and grid.is_area_walkable(*position):
+                    positions.append(position)
+
+        self.spawn_positions = positions or self.spawn_positions
+
+    def allocate_player_id(self, handler):
+        # ids are unique across every shard, the front-end reserved one when the client connected
+        self.connections[handler.reserved_player_id] = handler
+        return handler.reserved_player_id
+
+    def remove_player(self, player_id):
+        del self.players[player_id]
+        self.spatial_hash.remove(player_id)
+        self.connections.pop(player_id, None)
+
+        if player_id in self.published:
+            self.published.discard(player_id)
+            self.ghost_removals.append(player_id)
+
+    def remove_ghost(self, player_id):
+        data = util.despawn_codec.encode(player_id)
+
+        for handler in list(self.handlers):
+            if player_id in handler.interest:
+                handler.despawn_interest(player_id, data)
+
+        del self.players[player_id]
+        self.spatial_hash.remove(player_id)
+
+    def handle_connection(self, request, player_id, spawned, x, y, received, queued):
+        request.setblocking(False)
+
+        # a client that disconnected meanwhile is closed by its first read, which frees its id
+        try:
+            client_address = request.getpeername()
+        except socket.error:
+            client_address = None
+
+        handler = self.RequestHandlerClass(request, client_address, self)
+        handler.reserved_player_id = player_id
+
+        self.selector.register(request, selectors.EVENT_READ, handler)
+
+        # whatever the previous shard couldn't send yet goes out before anything of ours
+        if queued:
+            handler.write_queue.append(queued)
+            handler.write_queue_size += len(queued)
+
+        handler.setup_player()
+
+        if spawned:
+            self.adopt_player(handler, player_id, x, y)
+
+        if received:
+            handler.handle_data(received)
+
+        if not handler.closed:
+            handler.handle_write()
+
+    def adopt_player(self, handler, player_id, x, y):
+        player = self.players.get(player_id)
+
+        # the player was a ghost of ours while it was near the border
+        if player is None:
+            self.players.add(player_id, True, x, y)
+        else:
+            player.owner = True
+            self.players.set_position(player_id, x, y)
+
+        self.players.mark_dirty(player_id)
+
+        # the client already has its own player, the rest is spawned by the next tick
+        handler.player_id = player_id
+        handler.interest.add(player_id)
+
+        # the shard it came from keeps a ghost of it, which has to be updated or removed by us
+        self.connections[player_id] = handler
+        self.published.add(player_id)
+
+        metrics.increment('shard.handoffs_in')
+
+    def hand_off(self, handler, x, y):
+        player_id = handler.player_id
+
+        # the client forgets every player we spawned for it, its new shard spawns the ones it can see
+        for other_id in list(handler.interest):
+            if other_id != player_id:
+                handler.despawn_interest(other_id)
+
+        if handler.closed:
+            return
+
+        handler.closed = True
+        self.selector.unregister(handler.request)
+        self.remove_handler(handler)
+
+        # the player stays here as a ghost until its new shard removes it
+        del self.connections[player_id]
+        self.published.discard(player_id)
+        self.players[player_id].owner = False
+
+        received = handler.decoder.data
+        queued = b''.join(handler.write_queue)
+
+        self.link.send(handoff_codec.encode(player_id, True, x, y, len(received), len(queued)) + received + queued,
+            handler.request)
+
+        metrics.increment('shard.handoffs_out')
+
+    def collect_dirty_players(self):
+        dirty_players = server.SelectorServer.collect_dirty_players(self)
+
+        for player_id, (x, y) in list(dirty_players.items()):
+            handler = self.connections.get(player_id)
+
+            # ghosts are published by the shard that owns them
+            if handler is None:
+                continue
+
+            if self.layout.has_left(self.index, x, y):
+                self.hand_off(handler, x, y)
+            elif self.layout.is_near_border(self.index, x, y):
+                self.ghost_updates.append((player_id, x, y))
+                self.published.add(player_id)
+            elif player_id in self.published:
+                self.published.discard(player_id)
+                self.ghost_removals.append(player_id)
+
+        return dirty_players
+
+    def tick(self):
+        server.SelectorServer.tick(self)
+
+        metrics.set_gauge('shard.ghosts', len(self.players) - len(self.connections))
+
+        if not self.ghost_updates and not self.ghost_removals:
+            return
+
+        self.link.send(encode_ghosts(self.ghost_updates, self.ghost_removals))
+
+        self.ghost_updates = []
+        self.ghost_removals = []
+
+    def close_request(self, handler):
+        if handler.closed:
+            return
+
+        server.SelectorServer.close_request(self, handler)
+
+        self.link.send(closed_codec.encode(handler.reserved_player_id))
+
+    def handle_link_message(self, link, packet_id, data_buffer):
+        if packet_id == LINK_CONNECTION:
+            player_id, spawned, x, y, received_size, queued_size = connection_codec.decode(data_buffer)
+
+            received = data_buffer.read(received_size).tobytes()
+            queued = data_buffer.read(queued_size).tobytes()
+
+            self.handle_connection(link.received_sockets.popleft(), player_id, spawned, x, y, received, queued)
+
+        elif packet_id == LINK_GHOSTS:
+            updates, removals = decode_ghosts(data_buffer)
+
+            for player_id, x, y in updates:
+                # a ghost of a player that was just handed off to us may still be on its way
+                if player_id in self.connections:
+                    continue
+
+                if player_id in self.players:
+                    self.players.set_position(player_id, x, y)
+                else:
+                    self.players.add(player_id, False, x, y)
+                    self.players.mark_dirty(player_id)
+
+            for player_id in removals:
+                if player_id in self.players and player_id not in self.connections:
+                    self.remove_ghost(player_id)
+
+    def handle_link_closed(self, link):
+        # the front-end is gone, and with it every client
+        raise SystemExit
+
+    def server_close(self):
+        self.selector.close()
+        self.link.request.close()
+
+class ShardRouter(object):
+    request_queue_size = 1024 # maximum pending tcp connections
+
+    player_ids = server.IdAllocator()
+
+    def __init__(self, server_address, layout):
+        self.server_address = server_address
+        self.layout = layout
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+
+        self.links = []
+
+        # the connections every shard serves and the shard serving every player
+        self.connections = []
+        self.player_shards = {}
+
+        # the shards holding a ghost of a player
+        self.ghost_holders = {}
+
+    def add_link(self, link_request):
+        link = ShardLink(link_request, self, len(self.links))
+        link.register(self.selector)
+
+        self.links.append(link)
+        self.connections.append(0)
+
+    def serve_forever(self, poll_interval=0.5):
+        while True:
+            for key, mask in self.selector.select(poll_interval):
+                if key.data is None:
+                    self.handle_accept()
+                    continue
+
+                link = key.data
+
+                if mask & selectors.EVENT_READ:
+                    link.handle_read()
+
+                if mask & selectors.EVENT_WRITE:
+                    link.handle_write()
+
+    def handle_accept(self):
+        # accept everything that is pending, not just one connection per wakeup
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+
+                raise
+
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # the id is reserved up front so it stays unique while the player moves between shards
+            player_id = self.player_ids.allocate()
+
+            # every id is in use, the server is full
+            if player_id is None:
+                metrics.increment('server.rejected_spawns')
+                request.close()
+                continue
+
+            # new clients go to the shard serving the fewest, which spawns them in its region
+            index = self.connections.index(min(self.connections))
+            self.send_connection(index, request, player_id)
+
+    def send_connection(self, index, request, player_id, spawned=False, x=0, y=0, received=b'', queued=b''):
+        self.player_shards[player_id] = index
+        self.connections[index] += 1
+
+        self.links[index].send(connection_codec.encode(player_id, spawned, x, y, len(received), len(queued)) +
+            received + queued, request)
+
+        self.update_gauges()
+
+    def update_gauges(self):
+        metrics.set_gauge('server.connections', len(self.player_shards))
+
+        for index, connections in enumerate(self.connections):
+            metrics.set_gauge('shard.%d.connections' % index, connections)
+
+    def handle_link_message(self, link, packet_id, data_buffer):
+        if packet_id == LINK_HANDOFF:
+            player_id, spawned, x, y, received_size, queued_size = handoff_codec.decode(data_buffer)
+
+            received = data_buffer.read(received_size).tobytes()
+            queued = data_buffer.read(queued_size).tobytes()
+
+            # the player is past the hysteresis, so the shard at its position keeps it
+            index = self.layout.get_shard(x, y)
+            self.connections[link.index] -= 1
+
+            # the shard it left keeps a ghost of it, the one it enters gets the real thing
+            holders = self.ghost_holders.setdefault(player_id, set())
+            holders.discard(index)
+            holders.add(link.index)
+
+            self.send_connection(index, link.received_sockets.popleft(), player_id, spawned, x, y, received, queued)
+            metrics.increment('shard.handoffs')
+
+        elif packet_id == LINK_CLOSED:
+            player_id, = closed_codec.decode(data_buffer)
+
+            self.connections[self.player_shards.pop(player_id)] -= 1
+            self.player_ids.release(player_id)
+
+            self.send_ghosts([], [(index, player_id) for index in self.ghost_holders.pop(player_id, ())])
+            self.update_gauges()
+
+        elif packet_id == LINK_GHOSTS:
+            updates, removals = decode_ghosts(data_buffer)
+
+            routed_updates = []
+            routed_removals = []
+
+            for player_id, x, y in updates:
+                # the player was handed off or disconnected since the shard sent this
+                if self.player_shards.get(player_id) != link.index:
+                    continue
+
+                holders = set(self.layout.get_ghost_shards(x, y))
+                holders.discard(link.index)
+
+                for index in self.ghost_holders.get(player_id, ()):
+                    if index not in holders:
+                        routed_removals.append((index, player_id))
+
+                for index in holders:
+                    routed_updates.append((index, (player_id, x, y)))
+
+                self.ghost_holders[player_id] = holders
+
+            for player_id in removals:
+                if self.player_shards.get(player_id) != link.index:
+                    continue
+
+                for index in self.ghost_holders.pop(player_id, ()):
+                    routed_removals.append((index, player_id))
+
+            self.send_ghosts(routed_updates, routed_removals)
+
+    def send_ghosts(self, routed_updates, routed_removals):
+        updates = [[] for link in self.links]
+        removals = [[] for link in self.links]
+
+        for index, entry in routed_updates:
+            updates[index].append(entry)
+
+        for index, player_id in routed_removals:
+            removals[index].append(player_id)
+
+        for link, link_updates, link_removals in zip(self.links, updates, removals):
+            if link_updates or link_removals:
+                link.send(encode_ghosts(link_updates, link_removals))
+
+    def handle_link_closed(self, link):
+        raise IOError('Shard %d exited!' % link.index)
+
+    def server_close(self):
+        self.selector.close()
+        self.socket.close()
+
+def get_metrics_filepath(filepath, index):
+    name, extension = os.path.splitext(filepath)
+    return '%s.shard%d%s' % (name, index, extension)
+
+def run_shard(index, link_request, layout, args):
+    # an interrupt goes to the whole process group, the front-end's exit closes our link and stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    shard_server = ShardServer(index, link_request, layout)
+    server.configure_server(shard_server, args)
+    shard_server.setup_spawn_positions()
+
+    if args.metrics:
+        metrics.dump_forever(get_metrics_filepath(args.metrics, index))
+
+    if args.metrics_port:
+        metrics.serve(port=args.metrics_port + index + 1)
+
+    shard_server.serve_forever(poll_interval=0.01)
+
+def create_layout(args):
+    walkability = collision.load_walkability(args.map) if args.map else None
+    if walkability:
+        world_width = walkability.width * walkability.tile_width
+        world_height = walkability.height * walkability.tile_height
+    else:
+        world_width = args.world_width or DEFAULT_WORLD_WIDTH
+        world_height = args.world_height or DEFAULT_WORLD_HEIGHT
+
+    # a player is seen by the clients up to the interest radius around its cell away,
+    # but only shows up on their screens within the client's view distance
+    cell_size = args.cell_size or server.get_cell_size(walkability)
+    margin = min((args.interest_radius + 1) * cell_size, CLIENT_VIEW_DISTANCE)
+
+    return ShardLayout(args.shards, world_width, world_height, margin)
+
+def serve(args):
+    layout = create_layout(args)
+
+    # shards are started fresh instead of forked, so they only inherit their own end of their link
+    context = multiprocessing.get_context('spawn')
+    router = ShardRouter((args.host, args.port), layout)
+
+    for index in range(args.shards):
+        router_request, shard_request = socket.socketpair()
+
+        process = context.Process(target=run_shard, args=(index, shard_request, layout, args))
+        process.daemon = True
+        process.start()
+
+        shard_request.close()
+        router.add_link(router_request)
+
+    if args.metrics:
+        metrics.dump_forever(args.metrics)
+
+    if args.metrics_port:
+        metrics.serve(port=args.metrics_port)
+
+    router.serve_forever(poll_interval=0.5)
@@ -1,14 +1,38 @@
-from struct import pack, unpack_from, calcsize
+import time
+import heapq
+import random
+import itertools
+import threading
+
+from struct import Struct, error as StructError
+
+# compiled structs are cached by format, so the format string is only parsed once
+struct_cache = {}
+
+def get_struct(fmt):
+    packer = struct_cache.get(fmt)
+
+    if packer is None:
+        packer = struct_cache[fmt] = Struct('!%s' % fmt)
+
+    return packer
 
 class DataBuffer(object):
 
     def __init__(self, data=bytes(), offset=0):
+        # received data is read in place, it is only copied into a
+        # growable bytearray the first time something is written to it
         self._data = data
+        self._length = len(data)
         self._offset = offset
 
     @property
     def data(self):
-        return self._data
+        return bytes(self._data[:self._length])
+
+    @property
+    def view(self):
+        return memoryview(self._data)[:self._length]
 
     @property
     def offset(self):
@@ -16,31 +40,57 @@ class DataBuffer(object):
 
     @property
     def remaining(self):
-        return self._data[self._offset:]
+        return memoryview(self._data)[self._offset:self._length]
+
+    def reserve(self, size):
+        if not isinstance(self._data, bytearray):
+            self._data = bytearray(self._data[:self._length])
+
+        required = self._length + size
+
+        # grow by at least the current capacity so appends stay amortized O(1)
+        if required > len(self._data):
+            self._data.extend(b'\0' * max(required - len(self._data), len(self._data)))
 
     def write(self, data):
         if not len(data):
             return
 
-        self._data += data
+        self.reserve(len(data))
+        self._data[self._length:self._length + len(data)] = data
+        self._length += len(data)
+
+    def writeStruct(self, packer, *args):
+        self.reserve(packer.size)
+        packer.pack_into(self._data, self._length, *args)
+        self._length += packer.size
 
     def writeTo(self, fmt, *args):
-        self.write(pack('!%s' % fmt, *args))
+        self.writeStruct(get_struct(fmt), *args)
 
     def read(self, length):
-        data = self._data[self._offset:][:length]
+        # note: the returned view must be released before writing to this buffer again
+        data = memoryview(self._data)[self._offset:min(self._offset + length, self._length)]
         self._offset += length
         return data
 
     def clear(self):
-        self._data = bytes()
+        self._data = bytearray()
+        self._length = 0
         self._offset = 0
 
-    def readFrom(self, fmt):
-        data = unpack_from('!%s' % fmt, self._data, self._offset)
-        self._offset += calcsize('!%s' % fmt)
+    def readStruct(self, packer):
+        if self._offset + packer.size > self._length:
+            raise StructError('unpack requires %d bytes, %d remaining' % (
+                packer.size, self._length - self._offset))
+
+        data = packer.unpack_from(self._data, self._offset)
+        self._offset += packer.size
         return data
 
+    def readFrom(self, fmt):
+        return self.readStruct(get_struct(fmt))
+
     def readByte(self):
         return self.readFrom('B')[0]
 
@@ -59,10 +109,316 @@ class DataBuffer(object):
     def writeShort(self, value):
         self.writeTo('h', int(value))
 
+    def readVarInt(self):
+        value = 0
+        shift = 0
+
+        while True:
+            byte = self.readByte()
+            value |= (byte & 0x7F) << shift
+
+            if not byte & 0x80:
+                return value
+
+            shift += 7
+
+    def writeVarInt(self, value):
+        value = int(value)
+
+        if value < 0:
+            raise ValueError('Cannot write negative varint %d!' % value)
+
+        # seven bits per byte, the high bit marks that another byte follows
+        while value > 0x7F:
+            self.writeByte((value & 0x7F) | 0x80)
+            value >>= 7
+
+        self.writeByte(value)
+
+    def readZigZag(self):
+        value = self.readVarInt()
+        return (value >> 1) ^ -(value & 1)
+
+    def writeZigZag(self, value):
+        # maps small negative and positive values to small unsigned ones: 0, -1, 1, -2...
+        value = int(value)
+        self.writeVarInt(value * 2 if value >= 0 else -value * 2 - 1)
+
+# every packet on the wire is prefixed with its length, so a stream of
+# bytes can be split back into packets no matter how tcp chunked it
+frame_header = get_struct('H')
+
+MAX_FRAME_SIZE = 0xFFFF
+
+def pack_frame(data):
+    if len(data) > MAX_FRAME_SIZE:
+        raise ValueError('Packet of %d bytes is too large to frame!' % len(data))
+
+    return frame_header.pack(len(data)) + data
+
+class PacketDecoder(object):
+
+    def __init__(self, header=frame_header):
+        self._header = header
+        self._buffer = bytearray()
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    @property
+    def data(self):
+        return bytes(self._buffer)
+
+    def feed(self, data):
+        self._buffer += data
+
+        packets = []
+        offset = 0
+
+        header = self._header
+
+        while len(self._buffer) - offset >= header.size:
+            length, = header.unpack_from(self._buffer, offset)
+            end = offset + header.size + length
+
+            # the rest of this packet hasn't arrived yet, keep it for the next read
+            if end > len(self._buffer):
+                break
+
+            # empty packets carry no packet id, there is nothing to handle
+            if length:
+                packets.append(DataBuffer(bytes(self._buffer[offset + header.size:end])))
+
+            offset = end
+
+        del self._buffer[:offset]
+        return packets
+
+    def clear(self):
+        self._buffer = bytearray()
+
 PACKET_REQUEST_SPAWN = 0x00
 PACKET_SPAWN = 0x01
 PACKET_DESPAWN = 0x02
 PACKET_POSITION_UPDATE = 0x03
+PACKET_SNAPSHOT = 0x04
+PACKET_DELTA_SNAPSHOT = 0x05
+PACKET_UDP_TOKEN = 0x06
+PACKET_TICK_RATE = 0x07
+
+class PacketCodec(object):
+
+    def __init__(self, packet_id, fmt):
+        self.packet_id = packet_id
+        self.fmt = fmt
+
+        # the body is read after the packet id was already read by the receive loop,
+        # while encoding packs the packet id and the body in one go
+        self.body = get_struct(fmt)
+        self.packet = get_struct('B%s' % fmt)
+
+    def encode(self, *args):
+        return self.packet.pack(self.packet_id, *[int(arg) for arg in args])
+
+    def write(self, data_buffer, *args):
+        data_buffer.writeStruct(self.packet, self.packet_id, *[int(arg) for arg in args])
+
+    def decode(self, data_buffer):
+        return data_buffer.readStruct(self.body)
+
+request_spawn_codec = PacketCodec(PACKET_REQUEST_SPAWN, '')
+
+# player ids are unsigned shorts, the low bits index a slot on the server and the high
+# bits count how many times that slot was reused, so a recycled slot gets a new id
+PLAYER_ID_INDEX_BITS = 12
+PLAYER_ID_GENERATION_BITS = 4
+
+# player id, owner, x, y
+spawn_codec = PacketCodec(PACKET_SPAWN, 'HBhh')
+
+# player id
+despawn_codec = PacketCodec(PACKET_DESPAWN, 'H')
+
+# player id, x, y
+position_update_codec = PacketCodec(PACKET_POSITION_UPDATE, 'Hhh')
+
+# snapshots sent per second, announced to every client when it connects, 0 when updates are re-broadcast
+tick_rate_codec = PacketCodec(PACKET_TICK_RATE, 'H')
+
+# the token a client has to put in its udp datagrams so the server knows which connection they belong to
+udp_token_codec = PacketCodec(PACKET_UDP_TOKEN, 'I')
+
+# entry count, followed by a player id, x, y entry for every player that moved
+snapshot_codec = PacketCodec(PACKET_SNAPSHOT, 'H')
+snapshot_entry_struct = get_struct('Hhh')
+
+# keeps a full snapshot packet well below the maximum frame size
+MAX_SNAPSHOT_ENTRIES = 4096
+
+# keeps a snapshot datagram below a typical mtu, so it is never fragmented,
+# an absolute delta entry takes at most 9 bytes with 16 bit player ids
+MAX_DATAGRAM_SNAPSHOT_ENTRIES = 160
+
+def encode_snapshots(entries):
+    packets = []
+
+    for index in range(0, len(entries), MAX_SNAPSHOT_ENTRIES):
+        batch = entries[index:index + MAX_SNAPSHOT_ENTRIES]
+
+        data_buffer = DataBuffer()
+        snapshot_codec.write(data_buffer, len(batch))
+
+        for player_id, x, y in batch:
+            data_buffer.writeStruct(snapshot_entry_struct, int(player_id), int(x), int(y))
+
+        packets.append(data_buffer.data)
+
+    return packets
+
+def decode_snapshot(data_buffer):
+    count, = snapshot_codec.decode(data_buffer)
+    return [data_buffer.readStruct(snapshot_entry_struct) for _ in range(count)]
+
+# delta snapshots only carry the players whose position changed from the last
+# position sent to that client, each entry starts with a varint of the player id
+# shifted left by two bits, the low two bits hold how the position is encoded:
+DELTA_SMALL = 0 # one byte, x and y deltas between -8 and 7 packed as two nibbles
+DELTA_VARINT = 1 # zigzag varint x and y deltas
+DELTA_ABSOLUTE = 2 # zigzag varint x and y, when the client has no baseline yet
+
+def encode_delta_entry(player_id, x, y, baseline=None):
+    data_buffer = DataBuffer()
+
+    if baseline is None:
+        data_buffer.writeVarInt(player_id << 2 | DELTA_ABSOLUTE)
+        data_buffer.writeZigZag(x)
+        data_buffer.writeZigZag(y)
+
+        return data_buffer.data
+
+    delta_x = int(x) - baseline[0]
+    delta_y = int(y) - baseline[1]
+
+    if -8 <= delta_x <= 7 and -8 <= delta_y <= 7:
+        data_buffer.writeVarInt(player_id << 2 | DELTA_SMALL)
+        data_buffer.writeByte((delta_x + 8) << 4 | (delta_y + 8))
+    else:
+        data_buffer.writeVarInt(player_id << 2 | DELTA_VARINT)
+        data_buffer.writeZigZag(delta_x)
+        data_buffer.writeZigZag(delta_y)
+
+    return data_buffer.data
+
+def encode_delta_snapshots(entries, max_entries=MAX_SNAPSHOT_ENTRIES):
+    packets = []
+
+    for index in range(0, len(entries), max_entries):
+        batch = entries[index:index + max_entries]
+
+        data_buffer = DataBuffer()
+        data_buffer.writeByte(PACKET_DELTA_SNAPSHOT)
+        data_buffer.writeVarInt(len(batch))
+        data_buffer.write(b''.join(batch))
+
+        packets.append(data_buffer.data)
+
+    return packets
+
+def decode_delta_snapshot(data_buffer, baseline):
+    entries = []
+
+    # the baseline is only advanced once the whole packet decoded, a packet that is
+    # dropped half way must leave it as the server last saw it
+    decoded = {}
+
+    for _ in range(data_buffer.readVarInt()):
+        header = data_buffer.readVarInt()
+        player_id, mode = header >> 2, header & 0x3
+
+        if mode == DELTA_ABSOLUTE:
+            x = data_buffer.readZigZag()
+            y = data_buffer.readZigZag()
+        else:
+            base = decoded.get(player_id) or baseline.get(player_id)
+
+            if base is None:
+                raise ValueError('Delta for player %d without a baseline!' % player_id)
+
+            base_x, base_y = base
+
+            if mode == DELTA_SMALL:
+                deltas = data_buffer.readByte()
+                x = base_x + (deltas >> 4) - 8
+                y = base_y + (deltas & 0xF) - 8
+            else:
+                x = base_x + data_buffer.readZigZag()
+                y = base_y + data_buffer.readZigZag()
+
+        # the decoded position is the baseline the server encodes the next delta against
+        decoded[player_id] = (x, y)
+        entries.append((player_id, x, y))
+
+    baseline.update(decoded)
+    return entries
+
+# every udp datagram starts with the connection's token and a sequence number,
+# datagrams with a sequence lower than the newest one received are stale and dropped
+datagram_header = get_struct('II')
+
+def pack_datagram(token, sequence, data):
+    return datagram_header.pack(token, sequence) + data
+
+def unpack_datagram(data):
+    data_buffer = DataBuffer(data)
+    token, sequence = data_buffer.readStruct(datagram_header)
+
+    return token, sequence, data_buffer
+
+class NetworkEmulator(object):
+
+    def __init__(self, loss=0.0, latency=0.0, jitter=0.0):
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, function, *args):
+        if random.random() < self.loss:
+            return
+
+        # jitter can deliver datagrams out of order, just like a real network
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+        if not delay:
+            return function(*args)
+
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+            heapq.heappush(self.queue, (time.time() + delay, next(self.counter), function, args))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+
+                due, counter, function, args = heapq.heappop(self.queue)
+
+            # the datagram was lost after all, for example the socket was closed meanwhile
+            try:
+                function(*args)
+            except (IOError, OSError):
+                pass
 
 # a list of random chosen spawn points around the map
 spawn_positions = [